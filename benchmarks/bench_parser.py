@@ -0,0 +1,186 @@
+import argparse
+import gc
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+import feedparser
+
+from benchmarks.memory_db import MemoryDatabase
+from benchmarks.synthetic_feed import generate_feed
+import storage
+
+storage.use_database(MemoryDatabase())
+
+import feed_parsing  # noqa: E402
+import rss_parser  # noqa: E402
+from feed_fetcher import FeedResult, entry_timestamp  # noqa: E402
+
+DEFAULT_SIZES = [10, 50, 100, 500]
+FEED_URL = "https://www.upwork.com/ab/feed/jobs/rss"
+
+# Every run needs a user (and feed version) nobody saw before
+_user_ids = itertools.count(10_000_000)
+
+
+class Stage:
+    # setup() builds fresh state for a run, run(state) is the timed part
+    def __init__(self, name, setup, run) -> None:
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+
+def _user(user_id):
+    return {"id": user_id, "settings": {}, "filters": {}}
+
+
+def build_stages(feed_bytes):
+    entries = feedparser.parse(feed_bytes).entries
+    summaries = [entry["summary"] for entry in entries]
+    published = [entry["published"] for entry in entries]
+    ids = [entry["id"] for entry in entries]
+
+    def cold_parse_setup():
+        rss_parser._parse_job_post.cache_clear()
+
+    def new_user_setup():
+        return next(_user_ids)
+
+    def seen_user_setup():
+        user_id = next(_user_ids)
+        rss_parser.jobs_db.insert_jobs(ids, user_id)
+        return user_id
+
+    def cold_seen_user_setup():
+        user_id = seen_user_setup()
+        rss_parser.jobs_db.seen_cache = storage.SeenCache()
+        return user_id
+
+    def cursor_user_setup():
+        # Subscriber that already got everything but the newest entry
+        user_id = next(_user_ids)
+        rss_parser.jobs_db.insert_jobs(ids[1:], user_id)
+        rss_parser.cursors_db.set_cursor(
+            rss_parser.normalize_url(FEED_URL), user_id, ids[1], entry_timestamp(entries[1]))
+        return user_id
+
+    def parse_rss(user_id):
+        result = FeedResult(entries, user_id, False)
+        rss_parser.RSSParser(FEED_URL, _user(user_id)).parse_rss(result)
+
+    return [
+        Stage("feedparser.parse", lambda: None, lambda _: feedparser.parse(feed_bytes)),
+        Stage("parse_feed (pool task)", lambda: None,
+              lambda _: feed_parsing.parse_feed(feed_bytes, {})),
+        Stage("_parse_budget", lambda: None,
+              lambda _: [feed_parsing._parse_budget(summary) for summary in summaries]),
+        Stage("_parse_country", lambda: None,
+              lambda _: [feed_parsing._parse_country(summary) for summary in summaries]),
+        Stage("_clean_summary", lambda: None,
+              lambda _: [feed_parsing._clean_summary(summary) for summary in summaries]),
+        Stage("_parse_published", lambda: None,
+              lambda _: [feed_parsing._parse_published(value) for value in published]),
+        Stage("parse_entry (cold)", cold_parse_setup,
+              lambda _: [rss_parser.parse_entry(entry) for entry in entries]),
+        Stage("parse_entry (cached)", lambda: None,
+              lambda _: [rss_parser.parse_entry(entry) for entry in entries]),
+        Stage("dedup (new user)", new_user_setup,
+              lambda user_id: rss_parser.jobs_db.insert_jobs(
+                  ids, user_id) or rss_parser.jobs_db.seen_job_ids(ids, user_id)),
+        Stage("dedup (seen, cold cache)", cold_seen_user_setup,
+              lambda user_id: rss_parser.jobs_db.seen_job_ids(ids, user_id)),
+        Stage("dedup (seen, warm cache)", seen_user_setup,
+              lambda user_id: rss_parser.jobs_db.seen_job_ids(ids, user_id)),
+        Stage("parse_rss (new user)", new_user_setup, parse_rss),
+        Stage("parse_rss (seen user)", seen_user_setup, parse_rss),
+        Stage("parse_rss (cursor, 1 new)", cursor_user_setup, parse_rss),
+    ]
+
+
+def measure(stage: Stage, entries, repeat):
+    best = None
+    for _ in range(repeat):
+        state = stage.setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage.run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    state = stage.setup()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    stage.run(state)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocations = sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                      if stat.count_diff > 0)
+
+    return {
+        "seconds": best,
+        "entries_per_sec": entries / best if best else float("inf"),
+        "peak_kb": peak / 1024,
+        "allocations": allocations,
+    }
+
+
+def run(sizes, repeat, seed):
+    results = {}
+    for size in sizes:
+        feed_bytes = generate_feed(size, seed=seed)
+        for stage in build_stages(feed_bytes):
+            results[f"{stage.name}@{size}"] = measure(stage, size, repeat)
+    return results
+
+
+def print_results(results, baseline=None, threshold=0.2):
+    regressions = []
+    print(f"{'stage':<36}{'entries/s':>14}{'ms':>10}{'peak KB':>10}{'allocs':>9}{'vs base':>10}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline:
+            ratio = result["entries_per_sec"] / baseline[name]["entries_per_sec"] - 1
+            change = f"{ratio:+.0%}"
+            if ratio < -threshold:
+                regressions.append(name)
+                change += " !"
+        print(f"{name:<36}{result['entries_per_sec']:>14,.0f}{result['seconds'] * 1000:>10.2f}"
+              f"{result['peak_kb']:>10.1f}{result['allocations']:>9}{change:>10}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Micro benchmarks for RSSParser and JobPostDB on synthetic Upwork feeds")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="entries per synthetic feed")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per stage, best one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", metavar="PATH", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown vs baseline reported as a regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+import copy
+import functools
+import itertools
+import math
+import threading
+
+import pymongo
+import pymongo.errors
+
+# Just enough of a pymongo database for JobPostDB/FeedsDB to run without a server,
+# unique indexes are real hash lookups so timings aren't dominated by scans
+
+_MISSING = object()
+
+
+def _get(document, path):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _matches(document, query):
+    for path, condition in query.items():
+        if path == "$or":
+            if not any(_matches(document, alternative) for alternative in condition):
+                return False
+            continue
+        value = _get(document, path)
+        if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            for operator, argument in condition.items():
+                if operator == "$in":
+                    if value not in argument:
+                        return False
+                elif operator == "$nin":
+                    if value in argument:
+                        return False
+                elif operator == "$exists":
+                    if (value is not _MISSING) != argument:
+                        return False
+                elif operator == "$gt":
+                    if value is _MISSING or not value > argument:
+                        return False
+                elif operator == "$lt":
+                    if value is _MISSING or not value < argument:
+                        return False
+                elif operator == "$gte":
+                    if value is _MISSING or not value >= argument:
+                        return False
+                elif operator == "$mod":
+                    # Truncated like MongoDB, negative values keep their sign
+                    divisor, remainder = argument
+                    if value is _MISSING or int(math.fmod(value, divisor)) != remainder:
+                        return False
+                else:
+                    raise NotImplementedError(operator)
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(document, projection):
+    if not projection:
+        return dict(document)
+    included = {key for key, include in projection.items() if include and key != "_id"}
+    result = {}
+    for key in included:
+        value = _get(document, key)
+        if value is _MISSING:
+            continue
+        # a.b keeps just b inside a
+        *parents, last = key.split(".")
+        target = result
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[last] = value
+    if projection.get("_id", 1) and "_id" in document:
+        result["_id"] = document["_id"]
+    return result
+
+
+def _evaluate(document, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict) and "$setIntersection" in expression:
+        first, *others = [_evaluate(document, argument) or [] for argument in expression["$setIntersection"]]
+        others = [set(other) for other in others]
+        return list(dict.fromkeys(value for value in first if all(value in other for other in others)))
+    return expression
+
+
+def _project_stage(document, projection):
+    result = {}
+    if projection.get("_id", 1) and "_id" in document:
+        result["_id"] = document["_id"]
+    for key, expression in projection.items():
+        if key == "_id":
+            continue
+        if expression in (1, True):
+            value = _get(document, key)
+            if value is not _MISSING:
+                result[key] = value
+        else:
+            result[key] = _evaluate(document, expression)
+    return result
+
+
+def _apply_update(document, update):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            parts = path.split(".")
+            target = document
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            if operator in ("$set", "$setOnInsert"):
+                target[parts[-1]] = value
+            elif operator == "$unset":
+                target.pop(parts[-1], None)
+            elif operator == "$inc":
+                target[parts[-1]] = target.get(parts[-1], 0) + value
+            elif operator == "$addToSet":
+                items = target.setdefault(parts[-1], [])
+                if value not in items:
+                    items.append(value)
+            elif operator == "$push":
+                items = target.setdefault(parts[-1], [])
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(value["$each"])
+                    if "$slice" in value:
+                        target[parts[-1]] = items[value["$slice"]:] if value["$slice"] < 0 else items[:value["$slice"]]
+                else:
+                    items.append(value)
+            else:
+                raise NotImplementedError(operator)
+
+
+def _locked(method):
+    # The bot touches collections from many threads, one lock per database keeps it simple
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.database.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MemoryCursor:
+    def __init__(self, documents) -> None:
+        self._documents = list(documents)
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        # Stable sorts, least significant key first
+        for field, field_direction in reversed(keys):
+            self._documents.sort(
+                key=lambda document: (document.get(field) is None, document.get(field)),
+                reverse=field_direction == pymongo.DESCENDING
+            )
+        return self
+
+    def limit(self, count):
+        if count:
+            self._documents = self._documents[:count]
+        return self
+
+    def __iter__(self):
+        return iter(self._documents)
+
+
+class MemoryCollection:
+    def __init__(self, database, name) -> None:
+        self.database = database
+        self.name = name
+        self._documents = {}
+        self._ids = itertools.count(1)
+        self._unique = {}
+
+    @_locked
+    def create_index(self, keys, unique=False, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        fields = tuple(field for field, _ in keys)
+        if unique and fields not in self._unique:
+            index = {}
+            for document in self._documents.values():
+                key = tuple(_get(document, field) for field in fields)
+                if key in index:
+                    raise pymongo.errors.DuplicateKeyError("duplicate key", 11000)
+                index[key] = document["_id"]
+            self._unique[fields] = index
+        return "_".join(f"{field}_1" for field in fields)
+
+    def _index_key(self, fields, document):
+        return tuple(_get(document, field) for field in fields)
+
+    def _insert(self, document):
+        document = dict(document)
+        document.setdefault("_id", next(self._ids))
+        for fields, index in self._unique.items():
+            if self._index_key(fields, document) in index:
+                raise pymongo.errors.DuplicateKeyError("duplicate key", 11000)
+        for fields, index in self._unique.items():
+            index[self._index_key(fields, document)] = document["_id"]
+        self._documents[document["_id"]] = document
+        return document
+
+    def _candidates(self, query):
+        # Use a unique index when every field of it is pinned by the query
+        for fields, index in self._unique.items():
+            values = []
+            for field in fields:
+                condition = query.get(field, _MISSING)
+                if condition is _MISSING:
+                    break
+                if isinstance(condition, dict):
+                    if set(condition) != {"$in"}:
+                        break
+                    values.append(condition["$in"])
+                else:
+                    values.append([condition])
+            else:
+                for key in itertools.product(*values):
+                    _id = index.get(key)
+                    if _id is not None:
+                        yield self._documents[_id]
+                return
+        yield from list(self._documents.values())
+
+    @_locked
+    def find(self, query=None, projection=None, **kwargs):
+        query = query or {}
+        return MemoryCursor(
+            _project(document, projection)
+            for document in self._candidates(query) if _matches(document, query)
+        )
+
+    @_locked
+    def find_one(self, query=None, projection=None):
+        for document in self.find(query, projection):
+            return document
+        return None
+
+    @_locked
+    def count_documents(self, query):
+        return sum(1 for _ in self.find(query))
+
+    @_locked
+    def insert_one(self, document):
+        self._insert(document)
+
+    @_locked
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        for position, document in enumerate(documents):
+            try:
+                self._insert(document)
+            except pymongo.errors.DuplicateKeyError:
+                errors.append({"index": position, "code": 11000})
+                if ordered:
+                    break
+        if errors:
+            raise pymongo.errors.BulkWriteError({"writeErrors": errors})
+
+    def _update(self, query, update, upsert, many):
+        matched = [document for document in self._candidates(query) if _matches(document, query)]
+        if not many:
+            matched = matched[:1]
+        for document in matched:
+            for fields, index in self._unique.items():
+                index.pop(self._index_key(fields, document), None)
+            _apply_update(document, {op: fields for op, fields in update.items() if op != "$setOnInsert"})
+            for fields, index in self._unique.items():
+                index[self._index_key(fields, document)] = document["_id"]
+        if not matched and upsert:
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            _apply_update(document, update)
+            matched = [self._insert(document)]
+        return matched
+
+    @_locked
+    def update_one(self, query, update, upsert=False):
+        self._update(query, update, upsert, many=False)
+
+    @_locked
+    def update_many(self, query, update, upsert=False):
+        self._update(query, update, upsert, many=True)
+
+    @_locked
+    def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=None):
+        if return_document == pymongo.ReturnDocument.BEFORE:
+            before = [copy.deepcopy(document) for document in self._candidates(query)
+                      if _matches(document, query)][:1]
+            self._update(query, update, upsert=False, many=False)
+            return _project(before[0], projection) if before else None
+        matched = self._update(query, update, upsert, many=False)
+        return _project(matched[0], projection) if matched else None
+
+    @_locked
+    def delete_many(self, query):
+        for document in [document for document in self._documents.values() if _matches(document, query)]:
+            for fields, index in self._unique.items():
+                index.pop(self._index_key(fields, document), None)
+            del self._documents[document["_id"]]
+
+    @_locked
+    def aggregate(self, pipeline, **kwargs):
+        documents = None
+        for stage in pipeline:
+            (operator, argument), = stage.items()
+            if operator == "$match":
+                documents = [document for document in
+                             (self._candidates(argument) if documents is None else documents)
+                             if _matches(document, argument)]
+            elif operator == "$project":
+                documents = [_project_stage(document, argument) for document in
+                             (self._documents.values() if documents is None else documents)]
+            else:
+                raise NotImplementedError(operator)
+        return MemoryCursor(self._documents.values() if documents is None else documents)
+
+    @_locked
+    def drop(self):
+        self._documents.clear()
+        self._unique.clear()
+
+
+class MemoryDatabase:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def command(self, *args, **kwargs):
+        return {"ok": 1}
@@ -0,0 +1,96 @@
+import random
+
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+COUNTRIES = [
+    "United States", "United Kingdom", "India", "Egypt", "Germany",
+    "Canada", "Australia", "Pakistan", "Netherlands", "Brazil",
+]
+SKILLS = [
+    "Python", "Django", "Flask", "JavaScript", "React", "Node.js",
+    "Web Scraping", "Data Analysis", "Machine Learning", "WordPress",
+    "PHP", "API Development", "Telegram Bot", "MongoDB", "AWS",
+]
+CATEGORIES = [
+    "Web Development", "Scripts & Utilities", "Data Science & Analytics",
+    "Full Stack Development", "Back-End Development",
+]
+WORDS = (
+    "we are looking for an experienced developer to help build maintain and improve "
+    "our platform the ideal candidate has strong communication skills attention to "
+    "detail and can start immediately please include examples of previous work"
+).split()
+
+
+def _summary(rng: random.Random, paragraphs: int, posted_on: datetime):
+    text = "<br />".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(25, 60))).capitalize() + "."
+        for _ in range(paragraphs)
+    )
+    if rng.random() < 0.5:
+        low = rng.choice([5, 10, 15, 20, 25, 35, 50])
+        budget = f"<b>Hourly Range</b>: ${low}.00-${low * 2}.00\n"
+    elif rng.random() < 0.9:
+        budget = f"<b>Budget</b>: ${rng.choice([50, 100, 250, 500, 1000, 1500, 5000]):,}\n"
+    else:
+        # Some posts come without any budget
+        budget = ""
+    skills = ",     ".join(rng.sample(SKILLS, rng.randint(2, 6)))
+    return (
+        f"{text}<br /><br />{budget}<br />"
+        f"<b>Posted On</b>: {posted_on.strftime('%B %d, %Y %H:%M')} UTC<br />"
+        f"<b>Category</b>: {rng.choice(CATEGORIES)}<br />"
+        f"<b>Skills</b>:{skills}\n<br />"
+        f"<b>Country</b>: {rng.choice(COUNTRIES)}\n<br />"
+        f"<a href=\"https://www.upwork.com/jobs/~01\">click to apply</a>\n"
+    )
+
+
+def entry_id(index):
+    return f"https://www.upwork.com/jobs/Synthetic-job_%7E{index:018d}?source=rss"
+
+
+def generate_entries(count, seed=0, start=0, now=None):
+    # Newest first like the real feed, ids start..start+count-1
+    rng = random.Random(seed + start)
+    now = now or datetime.now(timezone.utc)
+    entries = []
+    published = now
+    for offset in range(count):
+        index = start + count - 1 - offset
+        if offset:
+            published -= timedelta(minutes=rng.randint(1, 5))
+        entries.append({
+            "id": entry_id(index),
+            "title": f"{rng.choice(SKILLS)} {rng.choice(['developer', 'expert', 'needed', 'project'])} - Upwork",
+            "published": published.strftime("%a, %d %b %Y %H:%M:%S +0000"),
+            "summary": _summary(rng, rng.randint(1, 4), published),
+        })
+    return entries
+
+
+def render_feed(entries) -> bytes:
+    items = "".join(
+        "<item>"
+        f"<title><![CDATA[{entry['title']}]]></title>"
+        f"<link>{escape(entry['id'])}</link>"
+        f"<description><![CDATA[{entry['summary']}]]></description>"
+        f"<content:encoded><![CDATA[{entry['summary']}]]></content:encoded>"
+        f"<pubDate>{entry['published']}</pubDate>"
+        f"<guid>{escape(entry['id'])}</guid>"
+        "</item>"
+        for entry in entries
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">'
+        "<channel><title>All jobs | upwork.com</title>"
+        "<link>https://www.upwork.com/ab/feed/jobs/rss</link>"
+        "<description>All jobs | upwork.com</description>"
+        f"{items}</channel></rss>"
+    ).encode("utf-8")
+
+
+def generate_feed(count, seed=0, start=0, now=None) -> bytes:
+    return render_feed(generate_entries(count, seed, start, now))
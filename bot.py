@@ -1,12 +1,27 @@
-from typing import List
+import os
+import secrets
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import List, Tuple
+from urllib.parse import urlsplit
 import telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 from decouple import config
 
-from helper import ALLOWED_SETTINGS, ALLOWED_FILTERS, ITERABLE_FILTERS, HELP_TEXT, REPEAT_PERIOD, INITIAL_TUTORIAL
-from datetime import timedelta
+from helper import ALLOWED_SETTINGS, ALLOWED_FILTERS, ITERABLE_FILTERS, HELP_TEXT, SCHEDULER_TICK, INITIAL_TUTORIAL, METRICS_HOST, METRICS_PORT, SEND_GLOBAL_RATE, SEND_WORKERS, SHARD_LEASE_TTL, FEED_PROBE_PERIOD
 from storage import UsersDB, RSSFeed
-from rss_parser import RSSParser
+from rss_parser import RSSParser, cursors_db
+from scheduler import FeedScheduler
+from sharding import ShardCoordinator, shard_of
+from filters import filter_index
+from feed_fetcher import normalize_url
+from feed_health import FeedHealth, feed_health
+from digest import DigestBuffer, pack_messages
+from lanes import interactive_lane, polling_lane
+from message_queue import OutboundQueue
+from webhook import WebhookServer
+import metrics
 
 import logging
 logging.basicConfig(
@@ -16,43 +31,209 @@ BOT_TOKEN = config("TOKEN")
 DEV_IDS = config("DEVS", cast=lambda v: [int(
     s.strip()) for s in v.split(",")], default="0")
 
+# Only set to point the bot at a stand-in Bot API, ex: the load test harness
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default=None)
+
+# Public https url Telegram posts updates to, empty keeps long polling
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+WEBHOOK_LISTEN = config("WEBHOOK_LISTEN", default="0.0.0.0")
+WEBHOOK_PORT = config("WEBHOOK_PORT", cast=int, default=8443)
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = config("WEBHOOK_MAX_CONNECTIONS", cast=int, default=40)
+# all: one process does everything. Scaling out: a single front process answers
+# commands and any number of worker processes split the users and poll their feeds
+BOT_ROLE = config("BOT_ROLE", default="all")
+if BOT_ROLE not in ("all", "front", "worker"):
+    raise ValueError(f"BOT_ROLE must be all, front or worker, not {BOT_ROLE}")
+WORKER_ID = config("WORKER_ID", default=f"{socket.gethostname()}:{os.getpid()}")
+
 users_db = UsersDB()
-updater = Updater(token=BOT_TOKEN)
+# Handlers run in lanes.interactive_lane, the dispatcher's own pool is left idle.
+# Connections are sized for the outbound queue's senders, the bot's main users
+updater = Updater(token=BOT_TOKEN, base_url=TELEGRAM_API_URL, workers=1,
+                  request_kwargs={"con_pool_size": SEND_WORKERS + 4})
 dispatcher = updater.dispatcher
 job_queue = updater.job_queue
+outbound_queue = OutboundQueue(updater.bot)
+digest_buffer = DigestBuffer(outbound_queue.notify)
+webhook_server = WebhookServer(
+    updater.bot, dispatcher.update_queue, urlsplit(WEBHOOK_URL).path, WEBHOOK_SECRET)
 
 # Handlers methods
 
-# Callback method to run every x minutes looking for jobs
+# Called by the scheduler with every subscriber of a feed it just fetched
 
 
-def look_for_jobs_cb(context: CallbackContext):
-    chat_id = context.job.context
-    user_obj = users_db.get_user(chat_id)
-    rss_list: List[RSSFeed] = users_db.get_user_rss(chat_id)
-    show_summary = user_obj["settings"].get("show_summary", "no")
-    show_summary = False if show_summary == "no" else True
-    for rss in rss_list:
-        posts = RSSParser(rss["url"], user_obj).parse_rss()
+def deliver_posts(subscribers: List[Tuple[int, RSSFeed]], result):
+    if BOT_ROLE != "worker":
+        _deliver_posts(subscribers, result)
+        return
+    # A shard handed over mid cycle belongs to its new worker already,
+    # one being handed over now waits until these users' cursors are written
+    with coordinator.delivering([chat_id for chat_id, _ in subscribers]) as owned:
+        owned = set(owned)
+        subscribers = [(chat_id, rss) for chat_id, rss in subscribers if chat_id in owned]
+        if subscribers:
+            _deliver_posts(subscribers, result)
+
+
+def _deliver_posts(subscribers: List[Tuple[int, RSSFeed]], result):
+    parsers = {}
+    new_posts = {}
+    for chat_id, rss in subscribers:
+        try:
+            parsers[chat_id] = RSSParser(rss["url"], users_db.get_user(chat_id))
+            new_posts[chat_id] = parsers[chat_id].new_posts(result)
+        except Exception:
+            logging.exception(f"Reading {rss['url']} for {chat_id} failed")
+
+    # Match each new post against all subscribers at once
+    unique_posts = {post.url: post for posts in new_posts.values() for post in posts}
+    with metrics.FILTER_SECONDS.time(normalize_url(subscribers[0][1]["url"])):
+        accepted = filter_index.match_posts(unique_posts.values(), new_posts.keys())
+
+    for chat_id, rss in subscribers:
+        if chat_id not in new_posts:
+            continue
+        parser = parsers[chat_id]
+        show_summary = parser.user_settings.get("show_summary", "no")
+        show_summary = False if show_summary == "no" else True
+        timezone = parser.user_settings.get("timezone", "UTC")
+        posts = parser.filter_posts(new_posts[chat_id], accepted[chat_id])
         posts = posts[::-1]
-        for post in posts:
-            message = f"[{rss['name']}]\n\n{post.to_str(show_summary)}"
-            context.bot.send_message(chat_id=chat_id, text=message)
-
-
-def add_job_to_queue(user_id, interval, first):
-    job_name = f"job_{user_id}"
-    job_queue.run_repeating(
-        look_for_jobs_cb,
-        interval=interval,
-        first=first,
-        context=user_id,
-        name=job_name,
-    )
+        try:
+            if parser.user_settings.get("digest", "no") == "yes":
+                window = int(parser.user_settings.get("digest_window", "0")) * 60
+                texts = [post.to_str(show_summary, timezone) for post in posts]
+                digest_buffer.add(chat_id, f"[{rss['name']}]", texts, window)
+                continue
+            for post in posts:
+                message = f"[{rss['name']}]\n\n{post.to_str(show_summary, timezone)}"
+                outbound_queue.notify(chat_id=chat_id, text=message)
+        except Exception:
+            logging.exception(f"Sending {rss['url']} to {chat_id} failed")
+
+
+def feed_health_changed(subscribers: List[Tuple[int, RSSFeed]], health: FeedHealth):
+    for chat_id, rss in subscribers:
+        if BOT_ROLE == "worker" and not coordinator.owns(chat_id):
+            continue
+        if health.parked:
+            text = (f"Your RSS feed {rss['name']} keeps failing ({health.last_error}), "
+                    f"it's only retried every {FEED_PROBE_PERIOD / 3600:g} hours now. "
+                    f"Fix it with /delete_rss and /add_rss, adding it again retries it right away")
+        else:
+            text = f"Your RSS feed {rss['name']} works again"
+        outbound_queue.notify(chat_id=chat_id, text=text)
+
+
+scheduler = FeedScheduler(deliver_posts, feed_health_changed)
+
+
+def schedule_user(user):
+    scheduler.set_priority(user["id"], user.get("settings", {}).get("priority") == "high")
+    scheduler.set_user_feeds(user["id"], user["rss"])
+    filter_index.set_user_filters(user["id"], user.get("filters", {}))
+    if user.get("paused"):
+        scheduler.pause(user["id"])
+    else:
+        scheduler.resume(user["id"])
+
+
+def refresh_user_feeds(user_id):
+    # The front process leaves scheduling to the workers, they see the change on their next sync
+    if BOT_ROLE != "front":
+        scheduler.set_user_feeds(user_id, users_db.get_user_rss(user_id))
+
+
+def user_feed_urls(user):
+    return {normalize_url(rss["url"]) for rss in user["rss"]}
+
+
+# Worker mode
+
+
+def acquire_shards(shards):
+    user_ids = []
+    for user in users_db.get_subscribed_users(shards):
+        schedule_user(user)
+        user_ids.append(user["id"])
+    cursors_db.reload_users(user_ids)
+
+
+def release_shards(shards):
+    user_ids = [user_id for user_id in scheduler.user_ids() if shard_of(user_id) in shards]
+    for user_id in user_ids:
+        scheduler.set_user_feeds(user_id, [])
+        filter_index.remove_user(user_id)
+    cursors_db.forget_users(user_ids)
+
+
+coordinator = ShardCoordinator(WORKER_ID, acquire_shards, release_shards)
+# Newest updated_at synced, and the updated_at each user was last synced at
+_last_sync = None
+_synced = {}
+
+
+def run_user_feeds(user_id):
+    # /get_jobs, queued in the polling lane
+    try:
+        if not scheduler.run_user(user_id):
+            raise RuntimeError("Updates are paused")
+        # Same lane as the posts so it arrives after them
+        outbound_queue.notify(chat_id=user_id, text="Update completed")
+    except Exception:
+        outbound_queue.reply(chat_id=user_id,
+                             text="Something went wrong, make sure updates are not paused")
+
+
+def queue_user_run(user_id):
+    # Asking again before the run started doesn't queue another one
+    polling_lane.submit(run_user_feeds, user_id, key=("get_jobs", user_id))
+
+
+def sync_users():
+    # Picks up what the front process changed since the last sync. Its command threads
+    # don't commit in updated_at order, so the last SHARD_LEASE_TTL is read again each
+    # time and users already synced at the same updated_at are skipped
+    global _last_sync
+    since = _last_sync - timedelta(seconds=SHARD_LEASE_TTL) if _last_sync else datetime.min
+    for user in users_db.get_users_changed_since(since):
+        _last_sync = max(_last_sync or user["updated_at"], user["updated_at"])
+        if _synced.get(user["id"]) == user["updated_at"]:
+            continue
+        _synced[user["id"]] = user["updated_at"]
+        if not coordinator.owns(user["id"]):
+            continue
+        schedule_user(user)
+        cursors_db.forget_feeds(user["id"], user_feed_urls(user))
+        if user.get("retry_feeds"):
+            for url in users_db.take_feed_retries(user["id"]):
+                scheduler.retry_feed(url)
+        if user.get("run_requested") and users_db.take_run_request(user["id"]):
+            queue_user_run(user["id"])
+    for user_id in [user_id for user_id, updated_at in _synced.items() if updated_at < since]:
+        del _synced[user_id]
+
+
+def worker_heartbeat(context: CallbackContext):
+    coordinator.heartbeat()
+    outbound_queue.set_global_rate(SEND_GLOBAL_RATE / coordinator.live_workers)
+    sync_users()
+
+metrics.registry.gauge(
+    "upwork_send_queue", "Messages waiting in the outbound queue",
+    lambda: {name: value for name, value in outbound_queue.stats().items()
+             if name.startswith("queued_") or name == "delayed"},
+    "queue")
+metrics.registry.gauge(
+    "upwork_digest_posts", "Posts held for digest users until their window ends", digest_buffer.pending)
+metrics.registry.gauge(
+    "upwork_scheduled_feeds", "Distinct feeds the scheduler polls", lambda: len(scheduler.summary()))
 
 
 def start(update: telegram.Update, context: CallbackContext):
-    context.bot.send_message(
+    outbound_queue.reply(
         chat_id=update.effective_chat.id, text=INITIAL_TUTORIAL, parse_mode='html')
 
 # RSS CALL BACKS
@@ -65,70 +246,66 @@ def add_rss(update: telegram.Update, context: CallbackContext):
         rss_name = ' '.join(context.args[1:])
         rss_feed = RSSFeed(rss_name, rss_url)
         users_db.add_user_rss(user_id, rss_feed)
-        context.bot.send_message(
+        outbound_queue.reply(
             chat_id=update.effective_chat.id, text="Added RSS feed!")
-        # context.job_queue.run_repeating(
-        #    look_for_jobs_cb, interval=timedelta(minutes=15), first=5, context=user_id)
-        job_name = f"job_{user_id}"
-        jobs = job_queue.get_jobs_by_name(job_name)
-        if len(jobs) == 0:
-            add_job_to_queue(
-                user_id,
-                timedelta(minutes=REPEAT_PERIOD),
-                timedelta(minutes=REPEAT_PERIOD)
-            )
+        refresh_user_feeds(user_id)
+        if BOT_ROLE == "front":
+            users_db.request_feed_retry(user_id, rss_url)
+        else:
+            scheduler.retry_feed(rss_url)
 
     except IndexError:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Invalid input, please use /add_rss <rss_url> <rss_name>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="Invalid input, please use /add_rss <rss_url> <rss_name>")
 
 
 def list_rss(update: telegram.Update, context: CallbackContext):
     rss_list = users_db.get_user_rss(update.message.chat_id)
     if rss_list is None or not rss_list:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="No RSS feed to show, use /add_rss to add some first!")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="No RSS feed to show, use /add_rss to add some first!")
         return
+    lines = []
     for rss in rss_list:
-        message = f"[{rss['name']}]: {rss['url']}"
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=message)
+        line = f"[{rss['name']}]: {rss['url']}"
+        key = normalize_url(rss["url"])
+        # Only the workers track health in memory
+        health = feed_health.load(key) if BOT_ROLE == "front" else feed_health.get(key)
+        if health.parked:
+            line += f"\nFailing: {health.last_error}"
+        lines.append(line)
+    for message in pack_messages([("[FEEDS]", lines)]):
+        outbound_queue.reply(chat_id=update.effective_chat.id, text=message)
 
 
 def delete_rss(update: telegram.Update, context: CallbackContext):
     if len(context.args) == 0:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Invalid input, please use /delete_rss <rss_name>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="Invalid input, please use /delete_rss <rss_name>")
         return
     rss_name = ' '.join(context.args)
     user_id = update.message.chat_id
     users_db.delete_user_rss(user_id, rss_name)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Deleted {rss_name} RSS")
+    cursors_db.delete_feeds(user_id, user_feed_urls(users_db.get_user(user_id)))
+    refresh_user_feeds(user_id)
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=f"Deleted {rss_name} RSS")
 
 
 def pause_updates_cb(update: telegram.Update, context: CallbackContext):
-    user_id = update.message.chat_id
-    job_name = f"job_{user_id}"
-    jobs = job_queue.get_jobs_by_name(job_name)
-    for job in jobs:
-        job.schedule_removal()
-    context.bot.send_message(chat_id=update.message.chat_id,
-                             text="Paused updates, use /resume to start getting updates again")
+    users_db.set_paused(update.message.chat_id, True)
+    if BOT_ROLE != "front":
+        scheduler.pause(update.message.chat_id)
+    outbound_queue.reply(chat_id=update.message.chat_id,
+                         text="Paused updates, use /resume to start getting updates again")
 
 
 def resume_updates_cb(update: telegram.Update, context: CallbackContext):
-    user_id = update.message.chat_id
-    job_name = f"job_{user_id}"
-    jobs = job_queue.get_jobs_by_name(job_name)
-    if len(jobs) == 0:
-        add_job_to_queue(
-            user_id,
-            timedelta(minutes=REPEAT_PERIOD),
-            timedelta(minutes=REPEAT_PERIOD)
-        )
-    context.bot.send_message(chat_id=update.message.chat_id,
-                             text="Resumed updates, use /pause to pause updates when needed")
+    users_db.set_paused(update.message.chat_id, False)
+    if BOT_ROLE != "front":
+        scheduler.resume(update.message.chat_id)
+    outbound_queue.reply(chat_id=update.message.chat_id,
+                         text="Resumed updates, use /pause to pause updates when needed")
 
 
 def set_settings_cb(update: telegram.Update, context: CallbackContext):
@@ -136,36 +313,38 @@ def set_settings_cb(update: telegram.Update, context: CallbackContext):
         keyword = context.args[0].lower()
         value = context.args[1].lower()
         if keyword not in ALLOWED_SETTINGS.keys():
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=f"Invalid settings keyword, allowed keywords are: [{', '.join(ALLOWED_SETTINGS.keys())}]")
+            outbound_queue.reply(chat_id=update.effective_chat.id,
+                                 text=f"Invalid settings keyword, allowed keywords are: [{', '.join(ALLOWED_SETTINGS.keys())}]")
             return
     except IndexError:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Invalid input, please use /set <key_word> <value>")
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"Allowed keywords are: [{', '.join(ALLOWED_SETTINGS.keys())}]")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="Invalid input, please use /set <key_word> <value>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=f"Allowed keywords are: [{', '.join(ALLOWED_SETTINGS.keys())}]")
         return
     valid_values = ALLOWED_SETTINGS[keyword]["values"]
     value = ALLOWED_SETTINGS[keyword]["type"](value)
     if value not in valid_values:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=ALLOWED_SETTINGS[keyword]["error"])
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=ALLOWED_SETTINGS[keyword]["error"])
         return
     users_db.set_user_settings(update.message.chat_id, keyword, value)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Successfully set {keyword} = {value}!")
+    if keyword == "priority" and BOT_ROLE != "front":
+        scheduler.set_priority(update.message.chat_id, value == "high")
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=f"Successfully set {keyword} = {value}!")
 
 
 def list_settings_cb(update: telegram.Update, context: CallbackContext):
     settings = users_db.get_user_settings(update.message.chat_id)
     if not settings:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"No settings are set yet, please use /set <key_word> <value>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=f"No settings are set yet, please use /set <key_word> <value>")
         return
     message = "[SETTINGS]\n"
     message += "\n".join([f"{k} = {v}" for k, v in settings.items()])
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=message)
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=message)
 
 
 def add_filter_cb(update: telegram.Update, context: CallbackContext):
@@ -173,91 +352,165 @@ def add_filter_cb(update: telegram.Update, context: CallbackContext):
         keyword = context.args[0].lower()
         if keyword in ITERABLE_FILTERS:
             value = ' '.join(context.args[1:]).split(',')
-            value = [x.strip() for x in value]
+            value = [x.strip() for x in value if x.strip()]
+            if not value:
+                raise IndexError
         else:
             value = context.args[1]
         if keyword not in ALLOWED_FILTERS:
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=f"Invalid filter keyword, allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
+            outbound_queue.reply(chat_id=update.effective_chat.id,
+                                 text=f"Invalid filter keyword, allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
             return
     except IndexError:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Invalid input, please use /add_filter <key_word> <value>")
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"Allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="Invalid input, please use /add_filter <key_word> <value>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=f"Allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
         return
+    if keyword not in ITERABLE_FILTERS:
+        try:
+            value = ALLOWED_FILTERS[keyword]["type"](value.lower())
+        except ValueError:
+            value = None
+        valid_values = ALLOWED_FILTERS[keyword].get("values")
+        if value is None or (valid_values is not None and value not in valid_values):
+            outbound_queue.reply(chat_id=update.effective_chat.id,
+                                 text=ALLOWED_FILTERS[keyword]["error"])
+            return
     val = users_db.set_user_filter(update.message.chat_id, keyword, value)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Successfully set filter {keyword} = {val}")
+    filter_index.set_user_filters(
+        update.message.chat_id, users_db.get_user_filters(update.message.chat_id))
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=f"Successfully set filter {keyword} = {val}")
 
 
 def clear_filter_cb(update: telegram.Update, context: CallbackContext):
     try:
         keyword = context.args[0].lower()
         if keyword not in ALLOWED_FILTERS:
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=f"Invalid filter keyword, allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
+            outbound_queue.reply(chat_id=update.effective_chat.id,
+                                 text=f"Invalid filter keyword, allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
             return
     except IndexError:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Invalid input, please use /clear_filter <key_word>")
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"Allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="Invalid input, please use /clear_filter <key_word>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=f"Allowed keywords are: [{', '.join(ALLOWED_FILTERS)}]")
         return
     users_db.clear_user_filter(update.message.chat_id, keyword)
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Successfully cleared filter {keyword}")
+    filter_index.set_user_filters(
+        update.message.chat_id, users_db.get_user_filters(update.message.chat_id))
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=f"Successfully cleared filter {keyword}")
 
 
 def list_filters_cb(update: telegram.Update, context: CallbackContext):
     filters = users_db.get_user_filters(update.message.chat_id)
     if not filters:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"No filters are set yet, use /add_filter <key_word> <value>")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=f"No filters are set yet, use /add_filter <key_word> <value>")
         return
     message = "[FILTERS]\n"
     message += "\n".join([f"{k} = {v}" for k, v in filters.items()])
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=message)
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=message)
 
 
 def help_me_cb(update: telegram.Update, context: CallbackContext):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=HELP_TEXT, parse_mode=telegram.ParseMode.HTML)
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=HELP_TEXT, parse_mode=telegram.ParseMode.HTML)
 
 
 def unknown_command(update: telegram.Update, context: CallbackContext):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Sorry, I didn't understand that command!")
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text="Sorry, I didn't understand that command!")
 
 
 def list_jobs_cb(update: telegram.Update, context: CallbackContext):
     id = update.effective_chat.id
     if id not in DEV_IDS:
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="NOT AUTHORIZED")
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="NOT AUTHORIZED")
+        return
+    if BOT_ROLE != "all":
+        owners = coordinator.leases_db.owners(datetime.utcnow())
+        message = f"[WORKERS] {len(owners)}\n"
+        message += "\n".join([f"{owner} SHARDS: {shards}" for owner, shards in sorted(owners.items())])
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text=message[:telegram.constants.MAX_MESSAGE_LENGTH])
+        if BOT_ROLE == "front":
+            return
+    feeds = scheduler.summary()
+    message = f"[FEEDS] {len(feeds)}\n"
+    message += "\n".join([f"{url} SUBSCRIBERS: {subscribers} NEXT: {next_due}s EVERY: {interval}s"
+                          for url, subscribers, next_due, interval in feeds])
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=message[:telegram.constants.MAX_MESSAGE_LENGTH])
+
+
+def _histogram_line(name, histogram, labels=None):
+    count, total, p50, p95 = histogram.summary(labels)
+    if not count:
+        return f"{name}: -"
+    return f"{name}: {count} avg {total / count * 1000:.0f}ms p50<={p50 * 1000:g}ms p95<={p95 * 1000:g}ms"
+
+
+def stats_cb(update: telegram.Update, context: CallbackContext):
+    id = update.effective_chat.id
+    if id not in DEV_IDS:
+        outbound_queue.reply(chat_id=update.effective_chat.id,
+                             text="NOT AUTHORIZED")
         return
-    for job in job_queue.jobs():
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f"{job}, REMOVED: {job.removed} NEXT: {job.next_t}")
+    fetches = metrics.FEED_FETCHES.values()
+    by_status = {}
+    for (_, status), value in fetches.items():
+        by_status[status] = by_status.get(status, 0) + value
+    slowest = sorted(
+        ((total / sum(counts), feed) for (feed,), (counts, total) in metrics.FEED_FETCH_SECONDS.values().items()),
+        reverse=True)[:3]
+    db_commands = metrics.DB_COMMANDS.values()
+    queue_stats = outbound_queue.stats()
+
+    lines = ["[STATS]"]
+    lines.append(_histogram_line("fetch", metrics.FEED_FETCH_SECONDS))
+    lines.append("fetch status: " + ", ".join(
+        f"{status}={value}" for status, value in sorted(by_status.items(), key=lambda item: str(item[0]))))
+    lines.append(_histogram_line("parse", metrics.FEED_PARSE_SECONDS))
+    lines.append(_histogram_line("dedup", metrics.DEDUP_SECONDS))
+    lines.append(_histogram_line("filter", metrics.FILTER_SECONDS))
+    lines.append(_histogram_line("send", metrics.SEND_SECONDS))
+    lines.append(_histogram_line("cycle", metrics.CYCLE_SECONDS))
+    lines.append(f"cycle overruns: {metrics.CYCLE_OVERRUNS.total()}")
+    for lane in (interactive_lane, polling_lane):
+        lines.append(_histogram_line(f"{lane.name} lane wait", metrics.LANE_WAIT_SECONDS, (lane.name,)))
+    lines.append(f"db round trips: {sum(db_commands.values())}, errors: "
+                 f"{sum(value for (_, result), value in db_commands.items() if result == 'error')}")
+    for name, (hits, misses, size) in metrics.cache_stats().items():
+        rate = hits / (hits + misses) if hits + misses else 0
+        lines.append(f"cache {name}: {rate:.0%} hits, {size} entries")
+    lines.append("send queue: " + ", ".join(f"{k}={v}" for k, v in queue_stats.items()))
+    lines.extend(f"slow feed {avg * 1000:.0f}ms {feed}" for avg, feed in slowest)
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text="\n".join(lines)[:telegram.constants.MAX_MESSAGE_LENGTH])
 
 
 def run_job_cb(update: telegram.Update, context: CallbackContext):
     id = update.effective_chat.id
-    job_name = f"job_{id}"
-    jobs = job_queue.get_jobs_by_name(job_name)
-    try:
-        jobs[0].run(dispatcher)
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Update completed")
-    except Exception as e:
-        context.bot.send_message(chat_id=update.effective_chat.id,
+    if BOT_ROLE == "front":
+        # The worker owning this user runs it and sends "Update completed"
+        if users_db.get_user(id).get("paused"):
+            outbound_queue.reply(chat_id=id,
                                  text="Something went wrong, make sure updates are not paused")
+            return
+        users_db.request_run(id)
+        outbound_queue.reply(chat_id=id, text="Update requested")
+        return
+    queue_user_run(id)
 
 
 def id_cb(update: telegram.Update, context: CallbackContext):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=f"Your ID: {update.effective_chat.id}")
+    outbound_queue.reply(chat_id=update.effective_chat.id,
+                         text=f"Your ID: {update.effective_chat.id}")
 
 
 commands = {
@@ -273,28 +526,104 @@ commands = {
     "pause": pause_updates_cb,
     "resume": resume_updates_cb,
     "jobs": list_jobs_cb,
+    "stats": stats_cb,
     "get_jobs": run_job_cb,
     "id": id_cb,
     "help": help_me_cb
 }
 
+def in_interactive_lane(callback):
+    # The dispatcher thread only queues the command and goes back to reading updates.
+    # A chat's commands still run in the order they were sent, /pause then /resume stays resumed
+    def handler(update: telegram.Update, context: CallbackContext):
+        chat = update.effective_chat
+        interactive_lane.submit(callback, update, context, serial=chat.id if chat else None)
+    return handler
+
+
 for k, v in commands.items():
-    dispatcher.add_handler(CommandHandler(k, v))
+    dispatcher.add_handler(CommandHandler(k, in_interactive_lane(v)))
 
-unknown_command_handler = MessageHandler(Filters.command, unknown_command)
+unknown_command_handler = MessageHandler(Filters.command, in_interactive_lane(unknown_command))
 dispatcher.add_handler(unknown_command_handler)
 
 
-if __name__ == '__main__':
-    # Init jobs
-    for user in users_db.get_all_users():
-        if user["id"] == 1:
-            continue
-        job_name = f"job_{user['id']}"
-        add_job_to_queue(
-            user["id"],
-            timedelta(minutes=REPEAT_PERIOD),
-            timedelta(minutes=REPEAT_PERIOD)
+def queue_tick(context: CallbackContext):
+    # A tick still waiting for a polling thread covers this one too
+    polling_lane.submit(scheduler.tick, context, key="tick")
+
+
+def start_bot():
+    global _last_sync
+    if BOT_ROLE != "all":
+        # Workers load their shards' users, the front only ever deletes cursors
+        cursors_db.preload = False
+    if BOT_ROLE == "worker":
+        # From the front's clock, not this process's
+        _last_sync = users_db.last_updated_at()
+    if BOT_ROLE == "all":
+        for user in users_db.get_subscribed_users():
+            schedule_user(user)
+    if BOT_ROLE != "front":
+        # Workers start with no users, they come with the shards
+        job_queue.run_repeating(
+            queue_tick,
+            interval=SCHEDULER_TICK,
+            first=SCHEDULER_TICK,
+            name="feed_scheduler",
+        )
+        job_queue.run_repeating(
+            digest_buffer.flush_due,
+            interval=SCHEDULER_TICK,
+            first=SCHEDULER_TICK,
+            name="digest_flush",
         )
-    updater.start_polling(poll_interval=0.2, timeout=10)
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT, METRICS_HOST)
+    outbound_queue.start()
+    if BOT_ROLE == "worker":
+        job_queue.run_repeating(
+            worker_heartbeat,
+            interval=SHARD_LEASE_TTL / 3,
+            first=0,
+            name="worker_heartbeat",
+        )
+        # Only sends, commands go to the front process
+        updater.running = True
+        job_queue.start()
+    elif WEBHOOK_URL:
+        start_webhook()
+    else:
+        updater.start_polling(poll_interval=0.2, timeout=10)
+
+
+def start_webhook():
+    # What start_polling does, with updates coming from webhook_server instead
+    updater.running = True
+    job_queue.start()
+    threading.Thread(target=dispatcher.start, name="dispatcher", daemon=True).start()
+    webhook_server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    updater.bot.set_webhook(
+        url=WEBHOOK_URL,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        api_kwargs={"secret_token": WEBHOOK_SECRET}
+    )
+
+
+def stop_bot():
+    if BOT_ROLE == "worker":
+        coordinator.stop()
+    webhook_server.stop()
+    updater.stop()
+    # Work already running finishes, what it sends is drained with the rest
+    interactive_lane.shutdown(wait=True)
+    polling_lane.shutdown(wait=True, cancel=True)
+    # Held posts are already recorded as seen
+    digest_buffer.flush_all()
+    outbound_queue.stop()
+
+
+if __name__ == '__main__':
+    start_bot()
     updater.idle()
+    stop_bot()
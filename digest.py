@@ -0,0 +1,77 @@
+import threading
+import time
+
+from typing import Callable, Iterable, List, Tuple
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+SEPARATOR = "\n\n"
+
+
+def pack_messages(sections: Iterable[Tuple[str, List[str]]], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    # [(header, [text, ...]), ...] into as few messages of up to limit characters as possible,
+    # a header is written again when its texts carry on in the next message
+    messages = []
+    parts = []
+    size = 0
+    header_in_message = None
+    for header, texts in sections:
+        for text in texts:
+            piece = text if header_in_message == header else f"{header}{SEPARATOR}{text}"
+            if parts and size + len(SEPARATOR) + len(piece) > limit:
+                messages.append(SEPARATOR.join(parts))
+                parts = []
+                size = 0
+                piece = f"{header}{SEPARATOR}{text}"
+            piece = piece[:limit]
+            size += len(piece) + (len(SEPARATOR) if parts else 0)
+            parts.append(piece)
+            header_in_message = header
+    if parts:
+        messages.append(SEPARATOR.join(parts))
+    return messages
+
+
+class DigestBuffer:
+    # Posts for digest users, held per chat until its window ends and then sent
+    # packed, grouped by feed. Lives in memory, flush_all sends it all before stopping
+    def __init__(self, send: Callable[[int, str], None]) -> None:
+        self.send = send
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, chat_id, header, texts: List[str], window: float):
+        if not texts:
+            return
+        if window <= 0:
+            for message in pack_messages([(header, texts)]):
+                self.send(chat_id, message)
+            return
+        with self._lock:
+            _, items = self._pending.setdefault(chat_id, (time.monotonic() + window, []))
+            items.extend((header, text) for text in texts)
+
+    def _flush(self, chats):
+        for chat_id, items in chats:
+            sections = {}
+            for header, text in items:
+                sections.setdefault(header, []).append(text)
+            for message in pack_messages(sections.items()):
+                self.send(chat_id, message)
+
+    def flush_due(self, context=None):
+        now = time.monotonic()
+        with self._lock:
+            due = [chat_id for chat_id, (due_at, _) in self._pending.items() if due_at <= now]
+            chats = [(chat_id, self._pending.pop(chat_id)[1]) for chat_id in due]
+        self._flush(chats)
+
+    def flush_all(self):
+        with self._lock:
+            chats = list(self._pending.items())
+            self._pending.clear()
+        self._flush((chat_id, items) for chat_id, (_, items) in chats)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(items) for _, items in self._pending.values())
@@ -0,0 +1,299 @@
+import calendar
+import gzip
+import io
+import itertools
+import threading
+import time
+import zlib
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+import feedparser
+
+from feed_parsing import bozo_error, parse_pool
+from helper import (
+    FEED_CACHE_TTL,
+    FETCH_CONNECT_TIMEOUT,
+    FETCH_MAX_BYTES,
+    FETCH_READ_TIMEOUT,
+    FETCH_MAX_CONCURRENCY,
+    FETCH_PER_HOST_CONCURRENCY,
+    FETCH_TOTAL_TIMEOUT,
+    POLL_MAX_PERIOD,
+)
+from metrics import FEED_FETCHES, FEED_FETCH_SECONDS, FEED_PARSE_SECONDS
+from storage import FeedsDB
+
+feeds_db = FeedsDB()
+
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Retrying won't fix these, the url is wrong or gone
+PERMANENT_STATUSES = (400, 401, 403, 404, 410)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class FeedFetchError(Exception):
+    def __init__(self, message, permanent=False) -> None:
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def normalize_url(url: str) -> str:
+    # Same search can be pasted with different casing/param order, treat as one feed
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path or "/",
+        query,
+        ""
+    ))
+
+
+def entry_timestamp(entry) -> Optional[int]:
+    published = entry.get("published_parsed")
+    return calendar.timegm(published) if published else None
+
+
+def _newest_first(entries):
+    timestamps = [entry_timestamp(entry) for entry in entries]
+    return None not in timestamps and all(
+        newer >= older for newer, older in zip(timestamps, timestamps[1:]))
+
+
+@dataclass
+class FeedResult:
+    entries: List[Any]
+    version: int
+    not_modified: bool
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+    # Entries come newest first, so subscriber cursors can be trusted
+    ordered: bool = True
+    # What feedparser complained about while still finding the entries
+    bozo: Optional[str] = None
+    latency: float = 0.0
+
+
+# Body versions keep growing for the whole process, a feed dropped from the cache
+# and fetched again never reuses a version its subscribers already claimed
+_versions = itertools.count(1)
+
+
+class _InFlight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FeedCache:
+    def __init__(
+        self,
+        ttl: float = FEED_CACHE_TTL,
+        max_concurrency: int = FETCH_MAX_CONCURRENCY,
+        per_host_concurrency: int = FETCH_PER_HOST_CONCURRENCY,
+    ) -> None:
+        self.ttl = ttl
+        # Bodies outlive the TTL so a 304 can be answered from memory,
+        # feeds nobody asked for in a couple of the longest poll periods are dropped
+        self.retain = max(ttl * 6, POLL_MAX_PERIOD * 2)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._in_flight = {}
+        self._claims = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="feed_fetch")
+        self._host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(per_host_concurrency))
+
+    def _download(self, url, headers):
+        with self._lock:
+            host_slot = self._host_slots[urlsplit(url).hostname]
+        with host_slot:
+            deadline = time.monotonic() + FETCH_TOTAL_TIMEOUT
+            for _ in range(MAX_REDIRECTS + 1):
+                parts = urlsplit(url)
+                connection_cls = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+                connection = connection_cls(
+                    parts.hostname, parts.port, timeout=FETCH_CONNECT_TIMEOUT)
+                try:
+                    connection.connect()
+                    connection.sock.settimeout(FETCH_READ_TIMEOUT)
+                    path = parts.path or "/"
+                    if parts.query:
+                        path += "?" + parts.query
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                    location = response.getheader("Location")
+                    if response.status in REDIRECT_STATUSES and location:
+                        url = urljoin(url, location)
+                        continue
+                    response_headers = {k.lower(): v for k, v in response.getheaders()}
+                    body = self._read_body(url, response, deadline)
+                    encoding = response_headers.get("content-encoding", "")
+                    if encoding == "gzip":
+                        body = gzip.decompress(body)
+                    elif encoding == "deflate":
+                        body = zlib.decompress(body)
+                    return response.status, response_headers, body
+                except (OSError, HTTPException, zlib.error) as e:
+                    raise FeedFetchError(f"Failed fetching {url}: {e!r}") from e
+                finally:
+                    connection.close()
+        raise FeedFetchError(f"Too many redirects for {url}", permanent=True)
+
+    def _read_body(self, url, response, deadline):
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return b"".join(chunks)
+            size += len(chunk)
+            if size > FETCH_MAX_BYTES:
+                raise FeedFetchError(f"Failed fetching {url}: over {FETCH_MAX_BYTES} bytes", permanent=True)
+            if time.monotonic() > deadline:
+                raise FeedFetchError(f"Failed fetching {url}: took over {FETCH_TOTAL_TIMEOUT:g}s")
+            chunks.append(chunk)
+
+    def _fetch(self, key, url, headers):
+        try:
+            with FEED_FETCH_SECONDS.time(key):
+                status, response_headers, body = self._download(url, headers)
+        except FeedFetchError:
+            FEED_FETCHES.inc(key, "error")
+            raise
+        FEED_FETCHES.inc(key, str(status))
+        return status, response_headers, body
+
+    def _load(self, url, previous: Optional[FeedResult]) -> FeedResult:
+        if previous is not None:
+            etag, modified = previous.etag, previous.modified
+        else:
+            validators = feeds_db.get_validators(normalize_url(url))
+            etag, modified = validators.get("etag"), validators.get("modified")
+
+        headers = {
+            "User-Agent": feedparser.USER_AGENT,
+            "Accept-Encoding": "gzip, deflate",
+        }
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+
+        key = normalize_url(url)
+        start = time.monotonic()
+        status, response_headers, body = self._fetch(key, url, headers)
+        if status == 304 and previous is None:
+            # The stored validators may be another worker's, this process never saw
+            # that body and its subscribers may not have either
+            status, response_headers, body = self._fetch(key, url, {
+                name: value for name, value in headers.items() if not name.startswith("If-")})
+        latency = time.monotonic() - start
+        if status == 304 and previous is not None:
+            return FeedResult(previous.entries, previous.version, True, etag, modified,
+                              previous.ordered, previous.bozo, latency)
+
+        if status != 200:
+            raise FeedFetchError(f"Failed fetching {url}: HTTP {status}", permanent=status in PERMANENT_STATUSES)
+
+        with FEED_PARSE_SECONDS.time(key):
+            if parse_pool is not None:
+                entries, bozo = parse_pool.parse(body, response_headers)
+            else:
+                # feedparser opens bytes that look like a path, ex: a body of /etc/passwd
+                feed = feedparser.parse(io.BytesIO(body), response_headers=response_headers)
+                entries, bozo = feed.entries, bozo_error(feed)
+        if not entries and bozo:
+            raise FeedFetchError(f"Failed parsing {url}: {bozo}", permanent=True)
+        result = FeedResult(entries, next(_versions), False,
+                            response_headers.get("etag"),
+                            response_headers.get("last-modified"),
+                            _newest_first(entries),
+                            bozo,
+                            latency)
+        if (result.etag, result.modified) != (etag, modified):
+            feeds_db.set_validators(key, result.etag, result.modified)
+        return result
+
+    def _evict_stale(self, now):
+        # A feed being fetched keeps its body and claims, it's about to be replaced
+        stale = [key for key, (expires_at, _) in self._entries.items()
+                 if expires_at + self.retain <= now and key not in self._in_flight]
+        for key in stale:
+            del self._entries[key]
+            self._claims.pop(key, None)
+
+    def get(self, url) -> FeedResult:
+        key = normalize_url(url)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            previous = cached[1] if cached is not None else None
+            fetch = self._in_flight.get(key)
+            owner = fetch is None
+            if owner:
+                fetch = _InFlight()
+                self._in_flight[key] = fetch
+
+        # Someone else is already downloading this feed, wait for their result
+        if not owner:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.result
+
+        try:
+            fetch.result = self._load(url, previous)
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                now = time.monotonic()
+                self._evict_stale(now)
+                if fetch.error is None:
+                    self._entries[key] = (now + self.ttl, fetch.result)
+                del self._in_flight[key]
+            fetch.done.set()
+        return fetch.result
+
+    def iter_many(self, urls: Iterable[str]) -> Iterator[Tuple[str, Any]]:
+        # (url, FeedResult or the exception its fetch raised) as each fetch finishes,
+        # a slow feed doesn't hold back the others
+        futures = {self._executor.submit(self.get, url): url for url in dict.fromkeys(urls)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield futures[future], result
+
+    def claim(self, url, result: FeedResult, consumer) -> bool:
+        # False when this consumer already went through this exact body,
+        # which is what a 304 hands back
+        key = normalize_url(url)
+        with self._lock:
+            # Only the newest version's consumers are kept, a consumer still holding an older
+            # body gets through, the cursors and seen jobs catch what it repeats
+            version, consumers = self._claims.get(key, (0, set()))
+            if result.version == version:
+                if consumer in consumers:
+                    return False
+                consumers.add(consumer)
+            elif result.version > version:
+                self._claims[key] = (result.version, {consumer})
+            return True
+
+
+feed_cache = FeedCache()
@@ -0,0 +1,108 @@
+import logging
+import threading
+
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from feed_fetcher import FeedResult
+from helper import FEED_MAX_BACKOFF, FEED_MAX_FAILURES, FEED_PERMANENT_FAILURES, FEED_PROBE_PERIOD
+from metrics import registry
+from storage import FeedsDB
+
+logger = logging.getLogger(__name__)
+
+feeds_db = FeedsDB()
+
+# A healthy feed's latency is written back at most this often
+HEALTHY_WRITE_INTERVAL = timedelta(minutes=15)
+
+
+@dataclass
+class FeedHealth:
+    failures: int = 0
+    last_error: Optional[str] = None
+    permanent: bool = False
+    bozo: Optional[str] = None
+    latency: Optional[float] = None
+    parked: bool = False
+    checked_at: Optional[datetime] = None
+
+
+class FeedHealthTracker:
+    # Failures in a row per feed. Kept in the feeds collection, a parked
+    # feed stays parked after a restart instead of failing its way there again
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._health = None
+        self._written = {}
+
+    def _feeds(self):
+        if self._health is None:
+            self._health = {url: FeedHealth(**health) for url, health in feeds_db.get_health()}
+        return self._health
+
+    def get(self, key) -> FeedHealth:
+        with self._lock:
+            return self._feeds().get(key) or FeedHealth()
+
+    def load(self, key) -> FeedHealth:
+        # As last written by any process, for one that doesn't poll feeds itself
+        health = feeds_db.get_feed_health(key)
+        return FeedHealth(**health) if health else FeedHealth()
+
+    def _save(self, key, health, write=True):
+        self._feeds()[key] = health
+        if write:
+            feeds_db.set_health(key, asdict(health))
+            self._written[key] = health.checked_at
+
+    def record_success(self, key, result: FeedResult) -> bool:
+        # True when a parked feed came back
+        with self._lock:
+            previous = self._feeds().get(key) or FeedHealth()
+            health = FeedHealth(bozo=result.bozo, latency=round(result.latency, 3),
+                                checked_at=datetime.utcnow())
+            changed = previous.failures or previous.bozo != health.bozo
+            written = self._written.get(key)
+            stale = written is None or health.checked_at - written > HEALTHY_WRITE_INTERVAL
+            self._save(key, health, write=changed or stale)
+        return previous.parked
+
+    def record_failure(self, key, error: Exception) -> bool:
+        # True when this failure parked the feed
+        permanent = getattr(error, "permanent", False)
+        with self._lock:
+            previous = self._feeds().get(key) or FeedHealth()
+            failures = previous.failures + 1
+            limit = FEED_PERMANENT_FAILURES if permanent else FEED_MAX_FAILURES
+            health = FeedHealth(failures, str(error)[:300], permanent, previous.bozo, previous.latency,
+                                failures >= limit, datetime.utcnow())
+            self._save(key, health)
+        if health.parked and not previous.parked:
+            logger.warning(f"Parked {key} after {failures} failures: {error}")
+            return True
+        return False
+
+    def reset(self, key):
+        with self._lock:
+            if key in self._feeds():
+                self._save(key, FeedHealth())
+
+    def delay(self, key, interval):
+        # Seconds until the next poll of a feed normally polled every interval
+        health = self.get(key)
+        if health.parked:
+            return FEED_PROBE_PERIOD
+        if health.failures:
+            return min(interval * 2 ** health.failures, max(FEED_MAX_BACKOFF, interval))
+        return interval
+
+    def parked_count(self):
+        with self._lock:
+            return sum(1 for health in self._feeds().values() if health.parked)
+
+
+feed_health = FeedHealthTracker()
+
+registry.gauge("upwork_parked_feeds", "Feeds parked after failing too often", feed_health.parked_count)
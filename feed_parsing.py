@@ -0,0 +1,216 @@
+import io
+import logging
+import multiprocessing
+import re
+import sys
+import threading
+import types
+import pytz
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import feedparser
+
+from helper import PARSE_BATCH_SIZE, PARSE_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+HOURLY_RANGE_RE = re.compile(r'<b>Hourly Range</b>:([^\n]+)')
+BUDGET_RE = re.compile(r'<b>Budget</b>: \$(\d[0-9,.]+)')
+COUNTRY_RE = re.compile(r'<b>Country</b>:([^\n]+)')
+BUDGET_TAGS_RE = re.compile(r'<[^<]+?>')
+TAGS_RE = re.compile(r'<.*?>')
+# Format Example: Sat, 24 Oct 2020 03:06:03 +0000
+PUBLISHED_FORMAT = '%a, %d %b %Y %H:%M:%S %z'
+
+
+# Everything here is pure CPU work on feed text, it can run in a parse_pool process
+
+
+def _parse_budget(summary):
+    if "Hourly Range" in summary:
+        budget = HOURLY_RANGE_RE.search(summary).group(1)
+        budget = budget.strip()
+        budget_no_dollar = budget.replace('$', '')
+        return budget, float(budget_no_dollar.split("-")[0]), True
+    try:
+        budget = '$' + BUDGET_RE.search(summary).group(1)
+        budget = BUDGET_TAGS_RE.sub('', budget)
+    except AttributeError:
+        budget = 'N/A'
+    try:
+        return budget, float(budget[1:].replace(',', '')), False
+    except:
+        return budget, None, (budget == "N/A")
+
+
+def _parse_country(summary):
+    try:
+        return COUNTRY_RE.search(summary).group(1)
+    except:
+        return 'N/A'
+
+
+def _clean_summary(summary):
+    return TAGS_RE.sub('', summary)
+
+
+def _parse_published(published_str):
+    return datetime.strptime(
+        published_str, PUBLISHED_FORMAT
+    ).replace(tzinfo=pytz.utc)
+
+
+def job_fields(summary, published_str):
+    # (budget, published, summary, budget_numeric, country, hourly), what a JobPost
+    # holds besides its url and title
+    budget, budget_numeric, hourly = _parse_budget(summary)
+    return (
+        budget,
+        _parse_published(published_str),
+        _clean_summary(summary),
+        budget_numeric,
+        _parse_country(summary),
+        hourly
+    )
+
+
+def _compact_entry(entry) -> Dict[str, Any]:
+    # Just what RSSParser reads, with the job fields already parsed. Small to send
+    # back, a FeedParserDict carries every field twice plus the raw html
+    compact = {
+        "id": entry.get("id", "#"),
+        "title": entry.get("title"),
+        "published": entry.get("published"),
+        "published_parsed": entry.get("published_parsed"),
+    }
+    try:
+        compact["fields"] = job_fields(entry.get("summary"), entry.get("published"))
+    except Exception:
+        # Left for parse_entry, which fails the same way as without the pool
+        compact["summary"] = entry.get("summary")
+    return compact
+
+
+def bozo_error(feed) -> Optional[str]:
+    # What feedparser had to work around, set for anything from a charset mismatch to html
+    if feed.get("bozo"):
+        return repr(feed.get("bozo_exception"))[:200]
+    return None
+
+
+def parse_feed(body, response_headers) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    # Never a path or url, feedparser would open a body that looks like one
+    feed = feedparser.parse(io.BytesIO(body), response_headers=response_headers)
+    return [_compact_entry(entry) for entry in feed.entries], bozo_error(feed)
+
+
+def _parse_batch(items):
+    # One bad body shouldn't fail the rest of its batch
+    results = []
+    for body, response_headers in items:
+        try:
+            results.append(parse_feed(body, response_headers))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _pool_context():
+    # Forking a process with this many threads can copy a held lock, workers
+    # are forked from a clean server process that preloaded this module
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+@contextmanager
+def _without_main():
+    # Workers start while submitting and would re-run the main script (bot.py, with its
+    # config, db clients and handlers) as __mp_main__. Nothing they run lives there
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+class ParsePool:
+    # Runs parse_feed in worker processes so big cycles don't hold the GIL.
+    # Bodies that queue up while every process is busy go out together as one task
+    def __init__(self, processes: int = PARSE_PROCESSES, batch_size: int = PARSE_BATCH_SIZE) -> None:
+        self.processes = processes
+        self.batch_size = batch_size
+        self._context = None
+        self._executor = None
+        self._ready = threading.Condition()
+        self._pending = []
+        self._slots = threading.BoundedSemaphore(processes)
+        self._thread = None
+
+    def _start(self):
+        # On first use, the worker processes import this module (and helper), never bot.py
+        self._context = _pool_context()
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=self._context)
+        self._thread = threading.Thread(target=self._dispatch, name="parse_pool", daemon=True)
+        self._thread.start()
+
+    def parse(self, body, response_headers) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        future = Future()
+        with self._ready:
+            if self._thread is None:
+                self._start()
+            self._pending.append((body, response_headers, future))
+            self._ready.notify()
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A worker died (OOM killer and the like), this body still gets parsed
+            return parse_feed(body, response_headers)
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            with self._ready:
+                while not self._pending:
+                    self._ready.wait()
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            items = [(body, response_headers) for body, response_headers, _ in batch]
+            try:
+                with _without_main():
+                    task = self._executor.submit(_parse_batch, items)
+            except BrokenProcessPool as e:
+                logger.error("Parse pool broke, starting new processes")
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=self._context)
+                self._finish(batch, None, error=e)
+                continue
+            task.add_done_callback(partial(self._finish, batch))
+
+    def _finish(self, batch, task, error=None):
+        self._slots.release()
+        try:
+            if error is not None:
+                raise error
+            results = task.result()
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), parsed in zip(batch, results):
+            if isinstance(parsed, Exception):
+                future.set_exception(parsed)
+            else:
+                future.set_result(parsed)
+
+
+# 0 parses on the fetching threads, like before
+parse_pool = ParsePool() if PARSE_PROCESSES else None
@@ -0,0 +1,183 @@
+import re
+import threading
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Optional, Set
+
+
+def _normalize(value):
+    return " ".join(value.lower().split())
+
+
+def _normalize_all(values):
+    # Blank values never match anything, indexed they'd hide every post from an include filter
+    return frozenset(_normalize(value) for value in values if value.strip())
+
+
+def _keyword_pattern(keyword):
+    return re.escape(keyword).replace(r"\ ", r"\s+")
+
+
+class KeywordMatcher:
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.keywords = frozenset(_normalize(keyword) for keyword in keywords if keyword.strip())
+        # One alternation for all keywords so a post is scanned once however many there are,
+        # the lookahead stops at every position some keyword starts
+        alternation = "|".join(_keyword_pattern(keyword) for keyword in self.keywords)
+        self._re = re.compile(
+            r"(?=(?<!\w)(?:" + alternation + r")(?!\w))", re.IGNORECASE
+        ) if self.keywords else None
+        # Then every keyword is tried there, not just the longest: react and react-native,
+        # c and c++ both match. Others' keywords never change what a user's keywords find
+        self._by_first = defaultdict(list)
+        for keyword in self.keywords:
+            self._by_first[keyword[0]].append(
+                (keyword, re.compile(r"(?<!\w)" + _keyword_pattern(keyword) + r"(?!\w)", re.IGNORECASE)))
+
+    def find(self, text) -> Set[str]:
+        if self._re is None:
+            return set()
+        found = set()
+        for match in self._re.finditer(text):
+            position = match.start()
+            for keyword, pattern in self._by_first.get(text[position].lower(), ()):
+                if pattern.match(text, position):
+                    found.add(keyword)
+        return found
+
+
+def _post_text(post):
+    return f"{post.title or ''}\n{post.summary or ''}"
+
+
+class CompiledFilter:
+    def __init__(self, filters: Dict[str, Any]) -> None:
+        self.excluded_countries = _normalize_all(filters.get("exclude_countries", []))
+        self.include_keywords = _normalize_all(filters.get("include_keywords", []))
+        self.exclude_keywords = _normalize_all(filters.get("exclude_keywords", []))
+        self.min_budget = filters.get("min_budget")
+        self.max_budget = filters.get("max_budget")
+        self.job_type = filters.get("job_type")
+        self.keywords = KeywordMatcher(self.include_keywords | self.exclude_keywords)
+
+    @property
+    def has_post_filters(self):
+        return (self.min_budget is not None or self.max_budget is not None
+                or self.job_type is not None)
+
+    def accepts_budget(self, post):
+        if self.job_type is not None and self.job_type != ("hourly" if post.hourly else "fixed"):
+            return False
+        # Posts without a budget are never hidden by budget limits
+        if post.budget_numeric is None:
+            return True
+        if self.min_budget is not None and post.budget_numeric < self.min_budget:
+            return False
+        if self.max_budget is not None and post.budget_numeric > self.max_budget:
+            return False
+        return True
+
+    def __call__(self, post) -> bool:
+        if _normalize(post.country) in self.excluded_countries:
+            return False
+        if self.keywords.keywords:
+            found = self.keywords.find(_post_text(post))
+            if found & self.exclude_keywords:
+                return False
+            if self.include_keywords and not found & self.include_keywords:
+                return False
+        return self.accepts_budget(post)
+
+
+class FilterIndex:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._filters = {}
+        self._excluded_by_country = defaultdict(set)
+        self._included_by_keyword = defaultdict(set)
+        self._excluded_by_keyword = defaultdict(set)
+        self._include_users = set()
+        self._post_filter_users = set()
+        self._keywords = KeywordMatcher([])
+        self._keywords_dirty = False
+
+    def _unindex(self, user_id):
+        compiled = self._filters.pop(user_id, None)
+        if compiled is None:
+            return
+        for index, values in ((self._excluded_by_country, compiled.excluded_countries),
+                              (self._included_by_keyword, compiled.include_keywords),
+                              (self._excluded_by_keyword, compiled.exclude_keywords)):
+            for value in values:
+                index[value].discard(user_id)
+                if not index[value]:
+                    del index[value]
+        self._include_users.discard(user_id)
+        self._post_filter_users.discard(user_id)
+        self._keywords_dirty = True
+
+    def set_user_filters(self, user_id, filters: Dict[str, Any]) -> CompiledFilter:
+        compiled = CompiledFilter(filters)
+        with self._lock:
+            self._unindex(user_id)
+            self._filters[user_id] = compiled
+            for country in compiled.excluded_countries:
+                self._excluded_by_country[country].add(user_id)
+            for keyword in compiled.include_keywords:
+                self._included_by_keyword[keyword].add(user_id)
+            for keyword in compiled.exclude_keywords:
+                self._excluded_by_keyword[keyword].add(user_id)
+            if compiled.include_keywords:
+                self._include_users.add(user_id)
+            if compiled.has_post_filters:
+                self._post_filter_users.add(user_id)
+            self._keywords_dirty = True
+        return compiled
+
+    def remove_user(self, user_id):
+        with self._lock:
+            self._unindex(user_id)
+
+    def get(self, user_id, filters: Dict[str, Any]) -> CompiledFilter:
+        compiled = self._filters.get(user_id)
+        if compiled is None:
+            compiled = self.set_user_filters(user_id, filters)
+        return compiled
+
+    def _keywords_in(self, post) -> Set[str]:
+        if self._keywords_dirty:
+            self._keywords = KeywordMatcher(
+                list(self._included_by_keyword) + list(self._excluded_by_keyword))
+            self._keywords_dirty = False
+        return self._keywords.find(_post_text(post))
+
+    def match(self, post, user_ids: Iterable[Any]) -> Set[Any]:
+        with self._lock:
+            candidates = {user_id for user_id in user_ids if user_id in self._filters}
+            candidates -= self._excluded_by_country.get(_normalize(post.country), set())
+            keywords = self._keywords_in(post)
+            included = set()
+            for keyword in keywords:
+                candidates -= self._excluded_by_keyword.get(keyword, set())
+                included |= self._included_by_keyword.get(keyword, set())
+            candidates -= (candidates & self._include_users) - included
+            for user_id in candidates & self._post_filter_users:
+                if not self._filters[user_id].accepts_budget(post):
+                    candidates.discard(user_id)
+            return candidates
+
+    def match_posts(self, posts, user_ids: Iterable[Any]) -> Dict[Any, Optional[Set[str]]]:
+        # Maps every user to the urls of the posts they accept,
+        # None for users whose filters aren't indexed yet
+        user_ids = list(user_ids)
+        with self._lock:
+            accepted = {user_id: (set() if user_id in self._filters else None)
+                        for user_id in user_ids}
+        for post in posts:
+            for user_id in self.match(post, user_ids):
+                if accepted[user_id] is not None:
+                    accepted[user_id].add(post.url)
+        return accepted
+
+
+filter_index = FilterIndex()
@@ -1,4 +1,5 @@
 import pytz
+from decouple import config
 from datetime import datetime, timedelta
 
 ALLOWED_SETTINGS = {
@@ -11,18 +12,133 @@ ALLOWED_SETTINGS = {
         "values": ["yes", "no"],
         "type": str,
         "error": "Allowed show_summary values are yes/no."
+    },
+    "digest": {
+        "values": ["yes", "no"],
+        "type": str,
+        "error": "Allowed digest values are yes/no."
+    },
+    "digest_window": {
+        "values": ["0", "5", "15", "30", "60"],
+        "type": str,
+        "error": "Allowed digest_window values are 0/5/15/30/60 (minutes)."
+    },
+    "priority": {
+        "values": ["normal", "high"],
+        "type": str,
+        "error": "Allowed priority values are normal/high."
     }
 }
 
-ALLOWED_FILTERS = [
-    "exclude_countries",
-]
+ALLOWED_FILTERS = {
+    "exclude_countries": {
+        "type": str,
+        "error": "exclude_countries takes comma separated countries, ex: /add_filter exclude_countries India, Egypt"
+    },
+    "include_keywords": {
+        "type": str,
+        "error": "include_keywords takes comma separated keywords, ex: /add_filter include_keywords python, django"
+    },
+    "exclude_keywords": {
+        "type": str,
+        "error": "exclude_keywords takes comma separated keywords, ex: /add_filter exclude_keywords wordpress"
+    },
+    "min_budget": {
+        "type": float,
+        "error": "min_budget must be a number, ex: /add_filter min_budget 100"
+    },
+    "max_budget": {
+        "type": float,
+        "error": "max_budget must be a number, ex: /add_filter max_budget 5000"
+    },
+    "job_type": {
+        "values": ["hourly", "fixed"],
+        "type": str,
+        "error": "Allowed job_type values are hourly/fixed."
+    },
+}
 
 ITERABLE_FILTERS = [
     "exclude_countries",
+    "include_keywords",
+    "exclude_keywords",
 ]
 
 REPEAT_PERIOD = 10  # minutes
+# Feeds start at REPEAT_PERIOD, then each one is polled about every POLL_TARGET_POSTS
+# new posts by its own post rate, kept between POLL_MIN_PERIOD and POLL_MAX_PERIOD
+POLL_MIN_PERIOD = config("POLL_MIN_PERIOD", cast=float, default=120)  # seconds
+POLL_MAX_PERIOD = config("POLL_MAX_PERIOD", cast=float, default=1800)  # seconds
+POLL_TARGET_POSTS = config("POLL_TARGET_POSTS", cast=float, default=2)
+# Feeds with a "/set priority high" subscriber are polled at least this often
+PRIORITY_MAX_PERIOD = config("PRIORITY_MAX_PERIOD", cast=float, default=180)  # seconds
+
+# The scheduler wakes up this often and polls the feeds that are due
+SCHEDULER_TICK = 15  # seconds
+# Each feed's next poll is moved by up to this fraction of its period
+SCHEDULER_JITTER = 0.1
+
+# Telegram allows about 30 messages/s overall and 1 message/s per chat
+SEND_GLOBAL_RATE = config("SEND_GLOBAL_RATE", cast=float, default=25)  # messages/s
+SEND_CHAT_RATE = config("SEND_CHAT_RATE", cast=float, default=1)  # messages/s
+SEND_CHAT_BURST = config("SEND_CHAT_BURST", cast=float, default=3)
+SEND_MAX_RETRIES = config("SEND_MAX_RETRIES", cast=int, default=5)
+# Threads calling sendMessage, each one waits a round trip per message
+SEND_WORKERS = config("SEND_WORKERS", cast=int, default=8)
+# Seconds a stopping bot keeps sending what's still queued
+SEND_DRAIN_TIMEOUT = config("SEND_DRAIN_TIMEOUT", cast=float, default=30)
+
+# A fetched feed is shared by every subscriber polling it within this window
+FEED_CACHE_TTL = POLL_MIN_PERIOD / 2  # seconds
+
+# Feed downloads
+FETCH_CONNECT_TIMEOUT = config("FETCH_CONNECT_TIMEOUT", cast=float, default=5)  # seconds
+FETCH_READ_TIMEOUT = config("FETCH_READ_TIMEOUT", cast=float, default=15)  # seconds
+FETCH_MAX_CONCURRENCY = config("FETCH_MAX_CONCURRENCY", cast=int, default=16)
+FETCH_PER_HOST_CONCURRENCY = config("FETCH_PER_HOST_CONCURRENCY", cast=int, default=4)
+# Whole download, a server trickling bytes can't hold a fetch thread for longer
+FETCH_TOTAL_TIMEOUT = config("FETCH_TOTAL_TIMEOUT", cast=float, default=30)  # seconds
+FETCH_MAX_BYTES = config("FETCH_MAX_BYTES", cast=int, default=5 * 1024 * 1024)
+
+# A failing feed waits its period doubled for every failure in a row, up to FEED_MAX_BACKOFF.
+# After FEED_MAX_FAILURES in a row (FEED_PERMANENT_FAILURES when the url is gone or isn't
+# a feed) it's parked: subscribers are told and it's only probed every FEED_PROBE_PERIOD
+FEED_MAX_BACKOFF = config("FEED_MAX_BACKOFF", cast=float, default=3600)  # seconds
+FEED_MAX_FAILURES = config("FEED_MAX_FAILURES", cast=int, default=6)
+FEED_PERMANENT_FAILURES = config("FEED_PERMANENT_FAILURES", cast=int, default=2)
+FEED_PROBE_PERIOD = config("FEED_PROBE_PERIOD", cast=float, default=6 * 60 * 60)  # seconds
+
+# Processes parsing downloaded feeds, 0 parses on the fetching threads.
+# Feeds waiting while all of them are busy are sent over PARSE_BATCH_SIZE at a time
+PARSE_PROCESSES = config("PARSE_PROCESSES", cast=int, default=0)
+PARSE_BATCH_SIZE = config("PARSE_BATCH_SIZE", cast=int, default=8)
+
+# Upwork feeds never bring back week old posts, no need to remember them longer
+JOB_POSTS_RETENTION_DAYS = config("JOB_POSTS_RETENTION_DAYS", cast=int, default=7)
+# Parsed job posts shared between users, keyed by entry
+PARSED_CACHE_SIZE = 10000
+
+# User documents kept in memory
+USER_CACHE_SIZE = config("USER_CACHE_SIZE", cast=int, default=50000)
+
+# Delivered jobs remembered per user, 8 byte hashes, has to outnumber the posts of all their feeds
+SEEN_JOBS_PER_USER = config("SEEN_JOBS_PER_USER", cast=int, default=2000)
+# Delivered (user, job) pairs kept in memory, roughly 200 bytes each
+SEEN_CACHE_SIZE = config("SEEN_CACHE_SIZE", cast=int, default=200000)
+
+# Worker mode: users are split into SHARD_COUNT shards, leased by the live workers.
+# A lease not renewed for SHARD_LEASE_TTL seconds is taken over by another worker
+SHARD_COUNT = config("SHARD_COUNT", cast=int, default=64)
+SHARD_LEASE_TTL = config("SHARD_LEASE_TTL", cast=float, default=30)  # seconds
+
+# Threads answering commands, and threads running scheduler ticks and /get_jobs,
+# kept apart so commands are answered right away however busy polling gets
+UPDATE_WORKERS = config("UPDATE_WORKERS", cast=int, default=8)
+POLL_WORKERS = config("POLL_WORKERS", cast=int, default=2)
+
+# Prometheus style metrics on http://METRICS_HOST:METRICS_PORT/metrics, 0 turns them off
+METRICS_PORT = config("METRICS_PORT", cast=int, default=0)
+METRICS_HOST = config("METRICS_HOST", default="127.0.0.1")
 
 HELP_TEXT = f"""
 Hey! Get your Upwork feed delivered while focusing on work/learning!
@@ -37,11 +153,17 @@ Commands available:
 - Settings:
 <b>/set</b> &lt;key&gt; &lt;value&gt;: Set settings to value
 <b>/settings</b>: Displays your current settings
+<b>/set</b> digest yes: packs new posts into as few messages as possible
+<b>/set</b> digest_window &lt;0/5/15/30/60&gt;: with digest, holds posts up to that many minutes to send them together
+<b>/set</b> priority high: checks your feeds at least every {int(PRIORITY_MAX_PERIOD // 60)} minutes
 
 - Filters
 Available filters:
-exclude_countries
-for <b>exclude_countries</b> input is comma separated for multiple inputs
+exclude_countries, include_keywords, exclude_keywords, min_budget, max_budget, job_type
+for <b>exclude_countries</b>, <b>include_keywords</b> and <b>exclude_keywords</b> input is comma separated for multiple inputs
+<b>include_keywords</b> only lets through posts whose title or summary mention one of the keywords
+<b>min_budget</b>/<b>max_budget</b> compare with the fixed price or the lowest hourly rate, posts without a budget always pass
+<b>job_type</b> is hourly or fixed
 
 <b>/add_filter</b> &lt;filter&gt; &lt;value&gt;: sets filter's value
 <b>/clear_filter</b> &lt;filter&gt; clears filter's value
@@ -51,7 +173,7 @@ for <b>exclude_countries</b> input is comma separated for multiple inputs
 <b>/pause</b>: Pauses sending notifications
 <b>/resume</b>: Resumes sending notifications
 
-Notifications are sent out every {REPEAT_PERIOD} minutes!
+Busy feeds are checked every {int(POLL_MIN_PERIOD // 60)} minutes, quiet ones less often!
 New features will be out soon!
 
 <b>PS</b> You can support me at: https://www.buymeacoffee.com/iJohnMaged :)
@@ -69,7 +191,7 @@ Here's a quick tutorial on how to use the bot:
 - Add your RSS feeds:
 <b>/add_rss</b> &lt;rss url&gt; &lt;rss name&gt; ex: /add_rss https://url.com my_feed
 
-You can add multiple RSS feeds, once done, you'll be receiving notifications ever {REPEAT_PERIOD} minutes!
+You can add multiple RSS feeds, once done, you'll be receiving notifications every few minutes!
 
 Use <b>/help</b> for more info!
 New features will be out soon!
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional
+
+from helper import POLL_WORKERS, UPDATE_WORKERS
+from metrics import LANE_COALESCED, LANE_RUN_SECONDS, LANE_WAIT_SECONDS, registry
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    # Its own threads and queue, so work in one lane never waits behind another lane's.
+    # Submits with a key already waiting to start get that task instead of a new one,
+    # submits with the same serial run one at a time in the order they came
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"lane_{name}")
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._chains = {}
+        self._queued = 0
+
+    def _run(self, key, enqueued_at, fn, args):
+        with self._lock:
+            self._queued -= 1
+            if key is not None:
+                self._waiting.pop(key, None)
+        LANE_WAIT_SECONDS.observe(time.monotonic() - enqueued_at, self.name)
+        try:
+            with LANE_RUN_SECONDS.time(self.name):
+                return fn(*args)
+        except Exception:
+            logger.exception(f"Task in the {self.name} lane failed")
+            raise
+
+    def _run_chain(self, serial, task):
+        while task is not None:
+            future, enqueued_at, fn, args = task
+            try:
+                future.set_result(self._run(None, enqueued_at, fn, args))
+            except Exception as e:
+                future.set_exception(e)
+            with self._lock:
+                chain = self._chains[serial]
+                if chain:
+                    task = chain.popleft()
+                else:
+                    del self._chains[serial]
+                    task = None
+
+    def submit(self, fn: Callable[..., Any], *args, key: Optional[Hashable] = None,
+               serial: Optional[Hashable] = None) -> Future:
+        if serial is not None:
+            future = Future()
+            task = (future, time.monotonic(), fn, args)
+            with self._lock:
+                self._queued += 1
+                if serial in self._chains:
+                    # Its thread picks this up once the earlier ones are done
+                    self._chains[serial].append(task)
+                else:
+                    self._chains[serial] = deque()
+                    self._executor.submit(self._run_chain, serial, task)
+            return future
+        with self._lock:
+            if key is not None and key in self._waiting:
+                LANE_COALESCED.inc(self.name)
+                return self._waiting[key]
+            self._queued += 1
+            future = self._executor.submit(self._run, key, time.monotonic(), fn, args)
+            if key is not None:
+                self._waiting[key] = future
+        return future
+
+    def queued(self):
+        with self._lock:
+            return self._queued
+
+    def shutdown(self, wait=False, cancel=False):
+        # cancel drops the tasks still waiting for a thread
+        self._executor.shutdown(wait=wait, cancel_futures=cancel)
+
+
+# Command handlers, answering users is never stuck behind feed polling
+interactive_lane = Lane("interactive", UPDATE_WORKERS)
+# Scheduler ticks and on demand /get_jobs runs
+polling_lane = Lane("polling", POLL_WORKERS)
+
+registry.gauge(
+    "upwork_lane_queued", "Tasks waiting for a thread in each lane",
+    lambda: {lane.name: lane.queued() for lane in (interactive_lane, polling_lane)},
+    "lane")
@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.synthetic_feed import generate_entries, render_feed
+
+
+class FakeRSSServer:
+    # Serves `feeds` Upwork-like feeds and publishes new posts at `post_rate` posts/s overall
+    def __init__(self, feeds, post_rate, feed_size=50, backlog=10, seed=0) -> None:
+        self.post_rate = post_rate
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.feeds = [deque(maxlen=feed_size) for _ in range(feeds)]
+        self.versions = [0] * feeds
+        self.first_served = {}
+        self.fetches = 0
+        self.not_modified = 0
+        self._next_index = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        for feed in range(feeds):
+            for _ in range(backlog):
+                self._publish(feed)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._serve(self)
+
+        self._http = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._http.daemon_threads = True
+
+    def url(self, feed):
+        return f"http://127.0.0.1:{self._http.server_port}/ab/feed/jobs/rss?q=loadtest{feed}&sort=recency"
+
+    def _publish(self, feed):
+        with self._lock:
+            entry = generate_entries(1, seed=self.seed, start=self._next_index)[0]
+            self._next_index += 1
+            self.feeds[feed].appendleft(entry)
+            self.versions[feed] += 1
+
+    def _publisher(self):
+        while not self._stopped.wait(self.rng.expovariate(self.post_rate)):
+            self._publish(self.rng.randrange(len(self.feeds)))
+
+    def _serve(self, request):
+        query = parse_qs(urlsplit(request.path).query)
+        try:
+            feed = int(query["q"][0].replace("loadtest", ""))
+            entries = self.feeds[feed]
+        except (KeyError, ValueError, IndexError):
+            request.send_response(404)
+            request.end_headers()
+            return
+
+        with self._lock:
+            self.fetches += 1
+            etag = f'"{feed}-{self.versions[feed]}"'
+            if request.headers.get("If-None-Match") == etag:
+                self.not_modified += 1
+                not_modified = True
+            else:
+                not_modified = False
+                entries = list(entries)
+                now = time.time()
+                for entry in entries:
+                    self.first_served.setdefault(entry["id"], now)
+        if not_modified:
+            request.send_response(304)
+            request.end_headers()
+            return
+
+        body = render_feed(entries)
+        request.send_response(200)
+        request.send_header("Content-Type", "application/rss+xml; charset=utf-8")
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("ETag", etag)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        threading.Thread(target=self._http.serve_forever, name="fake_rss", daemon=True).start()
+        if self.post_rate > 0:
+            threading.Thread(target=self._publisher, name="fake_rss_publisher", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self._http.shutdown()
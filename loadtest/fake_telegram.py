@@ -0,0 +1,157 @@
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "load_test_bot"}
+
+
+class FakeTelegramServer:
+    # Answers the handful of Bot API methods bot.py uses, sendMessage takes `latency`
+    # seconds and fails with a 429 `error_rate` of the time
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1, seed=0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.sent = []
+        self.rate_limited = 0
+        # Set by setWebhook, updates are then POSTed there instead of waiting for getUpdates
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_rejected = 0
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._has_updates = threading.Condition(self._lock)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server._serve(self)
+
+            do_GET = do_POST
+
+        self._http = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._http.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._http.server_port}/bot"
+
+    def send_command(self, chat_id, command):
+        # Queue a message from chat_id, picked up by the bot's next getUpdates
+        text = f"/{command}"
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }
+        update = {"update_id": next(self._update_ids), "message": message}
+        if self.webhook_url:
+            self._post_update(update)
+            return
+        with self._has_updates:
+            self._updates.append(update)
+            self._has_updates.notify_all()
+
+    def _post_update(self, update):
+        parts = urlsplit(self.webhook_url)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+        try:
+            body = json.dumps(update).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if self.webhook_secret:
+                headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+            connection.request("POST", parts.path or "/", body, headers)
+            if connection.getresponse().status != 200:
+                with self._lock:
+                    self.webhook_rejected += 1
+        finally:
+            connection.close()
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1)
+        with self._has_updates:
+            # Everything before offset is confirmed by the bot
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates and timeout:
+                self._has_updates.wait(timeout)
+            return list(self._updates[:int(params.get("limit") or 100)])
+
+    def _send_message(self, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.rng.random() < self.error_rate:
+                self.rate_limited += 1
+                return None
+            self.sent.append((int(params["chat_id"]), params["text"], time.time()))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            "text": params["text"],
+        }
+
+    def _serve(self, request):
+        method = request.path.rsplit("/", 1)[-1]
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        try:
+            params = json.loads(body) if body else {}
+        except ValueError:
+            params = {}
+
+        if method == "getMe":
+            response = {"ok": True, "result": BOT_USER}
+        elif method == "getUpdates":
+            response = {"ok": True, "result": self._get_updates(params)}
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            self.webhook_secret = params.get("secret_token")
+            response = {"ok": True, "result": True}
+        elif method == "deleteWebhook":
+            self.webhook_url = None
+            response = {"ok": True, "result": True}
+        elif method == "sendMessage":
+            result = self._send_message(params)
+            if result is None:
+                response = {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            else:
+                response = {"ok": True, "result": result}
+        else:
+            response = {"ok": True, "result": True}
+
+        data = json.dumps(response).encode("utf-8")
+        request.send_response(429 if not response["ok"] else 200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def start(self):
+        threading.Thread(target=self._http.serve_forever, name="fake_telegram", daemon=True).start()
+
+    def stop(self):
+        self._http.shutdown()
@@ -0,0 +1,182 @@
+import argparse
+import os
+import random
+import re
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from loadtest.fake_rss import FakeRSSServer
+from loadtest.fake_telegram import FakeTelegramServer
+
+URL_RE = re.compile(r"^URL: (.+)$", re.MULTILINE)
+FIRST_USER_ID = 1_000_000
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return (f"p50 {pick(0.5):.2f}s  p90 {pick(0.9):.2f}s  "
+            f"p99 {pick(0.99):.2f}s  max {values[-1]:.2f}s")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Runs bot.py against a fake Telegram Bot API and fake RSS feeds")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--feeds", type=int, default=50)
+    parser.add_argument("--feeds-per-user", type=int, default=2)
+    parser.add_argument("--period", type=float, default=60,
+                        help="seconds between two fetches of a feed, REPEAT_PERIOD in production")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="poll each feed by its post rate, between a fifth and three times --period")
+    parser.add_argument("--tick", type=float, default=1, help="scheduler tick in seconds")
+    parser.add_argument("--duration", type=float, default=180, help="seconds to run")
+    parser.add_argument("--post-rate", type=float, default=2,
+                        help="new posts per second over all feeds")
+    parser.add_argument("--backlog", type=int, default=10, help="posts in every feed at start")
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="seconds the fake Bot API takes per sendMessage")
+    parser.add_argument("--error-rate", type=float, default=0.01,
+                        help="share of sendMessage calls answered with a 429")
+    parser.add_argument("--command-rate", type=float, default=1,
+                        help="/id commands per second sent by random users")
+    parser.add_argument("--digest", action="store_true",
+                        help="every user gets /set digest yes, new posts of a feed are packed together")
+    parser.add_argument("--webhook", action="store_true",
+                        help="receive commands on a local webhook instead of long polling")
+    parser.add_argument("--mongo", action="store_true",
+                        help="use the database from .env instead of an in-memory database")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    telegram_api = FakeTelegramServer(args.telegram_latency, args.error_rate, seed=args.seed)
+    rss_server = FakeRSSServer(args.feeds, args.post_rate, backlog=args.backlog, seed=args.seed)
+    telegram_api.start()
+    rss_server.start()
+
+    # bot.py reads its config at import time
+    os.environ["TOKEN"] = "123456:LOADTEST"
+    os.environ["TELEGRAM_API_URL"] = telegram_api.base_url
+    if args.webhook:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        os.environ["WEBHOOK_URL"] = f"http://127.0.0.1:{port}/telegram"
+        os.environ["WEBHOOK_LISTEN"] = "127.0.0.1"
+        os.environ["WEBHOOK_PORT"] = str(port)
+    import storage
+    if not args.mongo:
+        from benchmarks.memory_db import MemoryDatabase
+        storage.use_database(MemoryDatabase())
+    import bot
+    from feed_fetcher import feed_cache
+    from storage import RSSFeed
+
+    bot.SCHEDULER_TICK = args.tick
+    bot.scheduler.period = args.period
+    if args.adaptive:
+        bot.scheduler.min_period = args.period / 5
+        bot.scheduler.max_period = args.period * 3
+        bot.scheduler.priority_period = args.period / 2
+    else:
+        bot.scheduler.min_period = bot.scheduler.max_period = args.period
+    feed_cache.ttl = bot.scheduler.min_period / 2
+    feed_cache.retain = bot.scheduler.max_period * 2
+
+    users = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+    subscribers = {}
+    for user_id in users:
+        for feed in rng.sample(range(args.feeds), min(args.feeds_per_user, args.feeds)):
+            bot.users_db.add_user_rss(user_id, RSSFeed(f"feed{feed}", rss_server.url(feed)))
+            subscribers[feed] = subscribers.get(feed, 0) + 1
+        if args.digest:
+            bot.users_db.set_user_settings(user_id, "digest", "yes")
+
+    cycles = []
+    run_feeds = bot.scheduler._run_feeds
+
+    def timed_run_feeds(feeds, started):
+        start = time.monotonic()
+        run_feeds(feeds, started)
+        cycles.append((len(feeds), time.monotonic() - start))
+
+    bot.scheduler._run_feeds = timed_run_feeds
+
+    commands = {}
+    stopped = threading.Event()
+
+    def send_commands():
+        while not stopped.wait(rng.expovariate(args.command_rate)):
+            chat_id = rng.choice(users)
+            commands.setdefault(chat_id, []).append(time.time())
+            telegram_api.send_command(chat_id, "id")
+
+    print(f"{args.users} users, {args.feeds} feeds, {args.feeds_per_user} feeds per user, "
+          f"period {args.period:g}s, running for {args.duration:g}s")
+    started = time.time()
+    bot.start_bot()
+    if args.command_rate > 0:
+        threading.Thread(target=send_commands, daemon=True).start()
+    time.sleep(args.duration)
+    stopped.set()
+    elapsed = time.time() - started
+    queue_stats = bot.outbound_queue.stats()
+    sent = list(telegram_api.sent)
+    rss_server.stop()
+    # Sends what's queued, up to SEND_DRAIN_TIMEOUT, those don't count for the run
+    bot.stop_bot()
+    telegram_api.stop()
+
+    delivery = []
+    replies = []
+    delivered = {}
+    for chat_id, text, sent_at in sent:
+        urls = URL_RE.findall(text)
+        for url in urls:
+            served_at = rss_server.first_served.get(url)
+            if served_at is not None:
+                delivery.append(sent_at - served_at)
+            delivered[url] = delivered.get(url, 0) + 1
+        if not urls and text.startswith("Your ID:") and commands.get(chat_id):
+            replies.append(sent_at - commands[chat_id].pop(0))
+
+    durations = [duration for _, duration in cycles]
+    # Every post a subscriber was served should reach them once, there are no filters
+    expected = sum(subscribers.get(feed, 0) * len(rss_server.feeds[feed])
+                   for feed in range(args.feeds))
+
+    print(f"\nscheduler ticks with due feeds  {len(cycles)}")
+    if cycles:
+        print(f"  feeds per tick               {statistics.mean(n for n, _ in cycles):.1f} avg")
+        print(f"  tick duration                {percentiles(durations)}")
+        print(f"  busy                         {sum(durations) / elapsed:.0%} of the run")
+    print(f"feed fetches                   {rss_server.fetches} ({rss_server.not_modified} not modified)")
+    print(f"messages sent                  {len(sent)} "
+          f"({len(sent) / elapsed:.1f}/s), {telegram_api.rate_limited} answered 429")
+    print(f"posts delivered                {sum(delivered.values())} of at most {expected} "
+          f"({len(delivered)} unique)")
+    print(f"fetch to delivery              {percentiles(delivery)}")
+    print(f"command replies                {len(replies)} of {sum(map(len, commands.values())) + len(replies)}, "
+          f"{percentiles(replies)}")
+    if args.webhook:
+        print(f"webhook requests rejected      {telegram_api.webhook_rejected}")
+    print(f"outbound queue at stop         {queue_stats}")
+    print(f"sent while stopping            {len(telegram_api.sent) - len(sent)}")
+
+    # The queue still holding posts means Telegram, not fetching, is the limit
+    backlog = queue_stats.get("queued_notification", 0) + queue_stats.get("delayed", 0)
+    return 1 if cycles and max(durations) > bot.scheduler.min_period or backlog > len(sent) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from collections import Counter
+from typing import Any, Dict
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+from helper import (
+    SEND_GLOBAL_RATE,
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_MAX_RETRIES,
+    SEND_WORKERS,
+    SEND_DRAIN_TIMEOUT,
+)
+from metrics import SENDS, SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first
+INTERACTIVE = 0
+NOTIFICATION = 1
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    NOTIFICATION: "notification",
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        self._refill(now)
+        # Absolute time, every message waiting on this bucket gets the same one
+        ready = self.updated + max(0, 1 - self.tokens) / self.rate
+        return max(ready, self.blocked_until)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block_until(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _OutboundMessage:
+    def __init__(self, priority, seq, chat_id, kwargs) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class OutboundQueue:
+    def __init__(
+        self,
+        bot,
+        global_rate: float = SEND_GLOBAL_RATE,
+        chat_rate: float = SEND_CHAT_RATE,
+        chat_burst: float = SEND_CHAT_BURST,
+        max_retries: int = SEND_MAX_RETRIES,
+        workers: int = SEND_WORKERS,
+        drain_timeout: float = SEND_DRAIN_TIMEOUT,
+    ) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.drain_timeout = drain_timeout
+        self._queue = queue.PriorityQueue()
+        self._delayed = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._depth = Counter()
+        self._counters = Counter()
+        self._last_prune = time.monotonic()
+        self._stopped = threading.Event()
+        # A send blocks for a whole round trip, one thread alone can't get near the rate limit
+        self._threads = [
+            threading.Thread(target=self._run, name=f"outbound_queue_{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # Queued posts are already recorded as seen, they're sent before stopping when there's time
+        deadline = time.monotonic() + self.drain_timeout
+        while self.unsent() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        unsent = self.unsent()
+        if unsent:
+            logger.warning(f"Stopping with {unsent} messages unsent")
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def set_global_rate(self, rate):
+        # Workers sharing one bot token split Telegram's limit between them
+        self._global_bucket.rate = rate
+        self._global_bucket.capacity = rate
+
+    def _put(self, priority, chat_id, kwargs):
+        message = _OutboundMessage(priority, next(self._seq), chat_id, kwargs)
+        with self._lock:
+            self._depth[priority] += 1
+        self._queue.put((priority, message.seq, message))
+
+    def reply(self, chat_id, text, **kwargs):
+        # Answers to commands, sent ahead of any queued feed notification
+        self._put(INTERACTIVE, chat_id, dict(text=text, **kwargs))
+
+    def notify(self, chat_id, text, **kwargs):
+        self._put(NOTIFICATION, chat_id, dict(text=text, **kwargs))
+
+    def unsent(self):
+        # Queued, delayed and being sent
+        with self._lock:
+            return sum(self._depth.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {f"queued_{name}": self._depth[priority]
+                     for priority, name in PRIORITY_NAMES.items()}
+            stats["delayed"] = len(self._delayed)
+            stats.update(self._counters)
+        return stats
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self, now):
+        # Idle buckets are identical to brand new ones
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if bucket.idle(now)]:
+            del self._chat_buckets[chat_id]
+
+    def _defer(self, message, ready_at):
+        with self._lock:
+            heapq.heappush(self._delayed, (ready_at, message.priority, message.seq, message))
+
+    def _release_delayed(self, now):
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, message = heapq.heappop(self._delayed)
+                self._queue.put((priority, seq, message))
+            if self._delayed:
+                return self._delayed[0][0] - now
+        return 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            timeout = self._release_delayed(time.monotonic())
+            try:
+                _, _, message = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            now = time.monotonic()
+            with self._lock:
+                self._prune_buckets(now)
+                chat_bucket = self._chat_bucket(message.chat_id)
+                ready_at = chat_bucket.ready_at(now)
+                if ready_at <= now:
+                    # Taken now, a token short bucket makes the next sender wait longer
+                    wait = self._global_bucket.ready_at(now) - now
+                    self._global_bucket.consume(now)
+                    chat_bucket.consume(now)
+            if ready_at > now:
+                # Other chats shouldn't wait for this one
+                self._defer(message, ready_at)
+                continue
+            if wait > 0:
+                time.sleep(wait)
+            self._send(message)
+
+    def _send(self, message):
+        priority = PRIORITY_NAMES[message.priority]
+        try:
+            with SEND_SECONDS.time(priority):
+                self.bot.send_message(chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            SENDS.inc(priority, "rate_limited")
+            with self._lock:
+                self._counters["rate_limited"] += 1
+                self._chat_bucket(message.chat_id).block_until(time.monotonic() + e.retry_after)
+            self._retry(message, 0)
+            return
+        except (BadRequest, Unauthorized) as e:
+            # Blocked bot, deleted chat, bad markup.. retrying won't help
+            self._drop(message, e)
+            return
+        except (NetworkError, TelegramError) as e:
+            SENDS.inc(priority, "error")
+            self._retry(message, min(2 ** message.attempts, 30), e)
+            return
+        SENDS.inc(priority, "sent")
+        with self._lock:
+            self._depth[message.priority] -= 1
+            self._counters["sent"] += 1
+
+    def _retry(self, message, delay, error=None):
+        message.attempts += 1
+        if message.attempts > self.max_retries:
+            self._drop(message, error)
+            return
+        with self._lock:
+            self._counters["retried"] += 1
+        self._defer(message, time.monotonic() + delay)
+
+    def _drop(self, message, error):
+        logger.warning(f"Dropping message to {message.chat_id}: {error!r}")
+        SENDS.inc(PRIORITY_NAMES[message.priority], "dropped")
+        with self._lock:
+            self._depth[message.priority] -= 1
+            self._counters["dropped"] += 1
@@ -0,0 +1,271 @@
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Seconds, upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _label_order(item):
+    # Label values can mix types, ex: an http status next to "error"
+    return tuple(map(str, item[0]))
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self) -> Dict[Tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def total(self):
+        return sum(self.values().values())
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}"
+                for labels, value in sorted(self.values().items(), key=_label_order)]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def values(self):
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+
+    def summary(self, labels=None):
+        # (count, sum, p50, p95) over every label set, or only the given one
+        merged = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for key, (counts, value_sum) in self.values().items():
+            if labels is not None and key != labels:
+                continue
+            merged = [a + b for a, b in zip(merged, counts)]
+            total += value_sum
+        count = sum(merged)
+        return count, total, self._quantile(merged, count, 0.5), self._quantile(merged, count, 0.95)
+
+    def _quantile(self, counts, count, quantile):
+        if not count:
+            return 0.0
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= quantile * count:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = []
+        for labels, (counts, total) in sorted(self.values().items(), key=_label_order):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, read: Callable, label=None) -> None:
+        # read() returns a number, or {label value: number} when label is set
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = (label,) if label else ()
+
+    def values(self):
+        try:
+            value = self.read()
+        except Exception:
+            logger.exception(f"Reading gauge {self.name} failed")
+            return {}
+        if self.labels:
+            return {(key,): item for key, item in value.items()}
+        return {(): value}
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}"
+                for labels, value in sorted(self.values().items(), key=_label_order)]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=()) -> Histogram:
+        return self._add(Histogram(name, help, labels))
+
+    def gauge(self, name, help, read, label=None) -> Gauge:
+        return self._add(Gauge(name, help, read, label))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+FEED_FETCH_SECONDS = registry.histogram(
+    "upwork_feed_fetch_seconds", "Time to download a feed", ("feed",))
+FEED_FETCHES = registry.counter(
+    "upwork_feed_fetches_total", "Feed downloads by HTTP status, or error", ("feed", "status"))
+FEED_PARSE_SECONDS = registry.histogram(
+    "upwork_feed_parse_seconds", "Time feedparser spends on a downloaded feed", ("feed",))
+DEDUP_SECONDS = registry.histogram(
+    "upwork_dedup_seconds", "Time to look up and record delivered job ids for one subscriber", ("feed",))
+FILTER_SECONDS = registry.histogram(
+    "upwork_filter_seconds", "Time to match a feed's new posts against its subscribers", ("feed",))
+CURSOR_FALLBACKS = registry.counter(
+    "upwork_cursor_fallbacks_total", "Subscriber dedups that looked up every entry instead of using the cursor",
+    ("reason",))
+SEND_SECONDS = registry.histogram(
+    "upwork_send_seconds", "Bot API sendMessage round trip", ("priority",))
+SENDS = registry.counter(
+    "upwork_sends_total", "Outbound messages by result", ("priority", "result"))
+DB_SECONDS = registry.histogram(
+    "upwork_db_command_seconds", "MongoDB round trips", ("command",))
+DB_COMMANDS = registry.counter(
+    "upwork_db_commands_total", "MongoDB round trips by result", ("command", "result"))
+CYCLE_SECONDS = registry.histogram(
+    "upwork_scheduler_cycle_seconds", "Time a scheduler tick spends on its due feeds")
+CYCLE_OVERRUNS = registry.counter(
+    "upwork_scheduler_overruns_total", "Scheduler ticks that took longer than SCHEDULER_TICK")
+LANE_WAIT_SECONDS = registry.histogram(
+    "upwork_lane_wait_seconds", "Time a task waited in its lane's queue before a thread picked it up", ("lane",))
+LANE_RUN_SECONDS = registry.histogram(
+    "upwork_lane_run_seconds", "Time a lane's thread spent on a task", ("lane",))
+LANE_COALESCED = registry.counter(
+    "upwork_lane_coalesced_total", "Tasks merged into the same task already waiting in the lane", ("lane",))
+
+_caches = {}
+
+
+def _cache_stat(index):
+    return lambda: {name: read()[index] for name, read in list(_caches.items())}
+
+
+def watch_cache(name, read: Callable[[], Tuple[int, int, int]]):
+    # read() returns (hits, misses, size)
+    _caches[name] = read
+
+
+def cache_stats():
+    return {name: read() for name, read in list(_caches.items())}
+
+
+registry.gauge("upwork_cache_hits", "Cache hits since start", _cache_stat(0), "cache")
+registry.gauge("upwork_cache_misses", "Cache misses since start", _cache_stat(1), "cache")
+registry.gauge("upwork_cache_size", "Entries held by a cache", _cache_stat(2), "cache")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        DB_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        DB_COMMANDS.inc(event.command_name, "ok")
+
+    def failed(self, event):
+        DB_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        DB_COMMANDS.inc(event.command_name, "error")
+
+
+def start_server(port, host="127.0.0.1"):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
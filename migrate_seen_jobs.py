@@ -0,0 +1,8 @@
+from storage import JobPostDB
+
+# Moves delivered jobs from the old job_posts collection to the compact seen_jobs one.
+# Safe to run while the bot is up, it reads job_posts until it's restarted
+
+if __name__ == '__main__':
+    migrated = JobPostDB().migrate_legacy_jobs()
+    print(f"Migrated {migrated} job posts to seen_jobs")
@@ -1,34 +1,108 @@
-import feedparser
-import re
 import pytz
 import timeago
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set
 
-from storage import JobPostDB
+from feed_fetcher import FeedResult, entry_timestamp, feed_cache, normalize_url
+from feed_parsing import job_fields
+from filters import filter_index
+from helper import PARSED_CACHE_SIZE
+from metrics import CURSOR_FALLBACKS, DEDUP_SECONDS, watch_cache
+from storage import CursorsDB, JobPostDB
 
 jobs_db = JobPostDB()
+cursors_db = CursorsDB()
 
 
-@dataclass
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+
+@dataclass(frozen=True)
 class JobPost:
     url: str
     budget: str
-    published: str
+    published: datetime
     title: str
     summary: str
-    budget_numeric: int
+    budget_numeric: float
     country: str
     hourly: bool
 
-    def to_str(self, show_summary):
+    def published_ago(self, timezone="UTC"):
+        user_timezone = get_timezone(timezone)
+        timenow = datetime.utcnow().replace(
+            tzinfo=pytz.utc).astimezone(user_timezone)
+        return timeago.format(self.published.astimezone(user_timezone), timenow)
+
+    def to_str(self, show_summary, timezone="UTC"):
         job_type = "Hourly" if self.hourly else "Fixed-price"
+        published = self.published_ago(timezone)
         if show_summary:
-            return f"Title: {self.title}\nSummary: {self.summary[:500]}\nURL: {self.url}\nBudget: {self.budget}\nType: {job_type}\nPublished: {str(self.published)}\nCountry: {self.country}"
+            return f"Title: {self.title}\nSummary: {self.summary[:500]}\nURL: {self.url}\nBudget: {self.budget}\nType: {job_type}\nPublished: {published}\nCountry: {self.country}"
         else:
-            return f"Title: {self.title}\nURL: {self.url}\nBudget: {self.budget}\nType: {job_type}\nPublished: {str(self.published)}\nCountry: {self.country}"
+            return f"Title: {self.title}\nURL: {self.url}\nBudget: {self.budget}\nType: {job_type}\nPublished: {published}\nCountry: {self.country}"
+
+
+# Everything below until RSSParser is the same for every user, so it runs once per entry
+
+
+@lru_cache(maxsize=PARSED_CACHE_SIZE)
+def _parse_job_post(job_id, title, summary, published_str, fields=None):
+    if fields is None:
+        fields = job_fields(summary, published_str)
+    budget, published, clean_summary, budget_numeric, country, hourly = fields
+    return JobPost(
+        job_id,
+        budget,
+        published,
+        title,
+        clean_summary,
+        budget_numeric,
+        country,
+        hourly
+    )
+
+
+def parse_entry(entry) -> JobPost:
+    fields = entry.get("fields")
+    if fields is not None:
+        # Parsed by parse_pool already, the fields stand in for the summary in the key
+        return _parse_job_post(entry.get("id", "#"), entry.get("title"), None, entry.get("published"), fields)
+    # Keyed by the raw fields too, an edited post gets parsed again
+    return _parse_job_post(
+        entry.get("id", "#"),
+        entry.get("title"),
+        entry.get("summary"),
+        entry.get("published")
+    )
+
+
+def _parsed_cache_stats():
+    info = _parse_job_post.cache_info()
+    return info.hits, info.misses, info.currsize
+
+
+watch_cache("parsed_entries", _parsed_cache_stats)
+
+
+def _entries_after_cursor(entries, cursor):
+    # Entries above the subscriber's cursor in a newest first feed, None when
+    # the cursor entry isn't where it should be and every entry needs checking
+    new_entries = []
+    for entry in entries:
+        if entry["id"] == cursor["entry_id"]:
+            return new_entries
+        if entry_timestamp(entry) < cursor["published"]:
+            # Cursor entry was removed, or a post showed up late with an older date
+            return None
+        new_entries.append(entry)
+    # Cursor fell off the feed, more posts came than the feed holds
+    return None
 
 
 class RSSParser:
@@ -39,80 +113,69 @@ class RSSParser:
         self.user_id = user_obj["id"]
 
     def _load_rss(self):
-        return feedparser.parse(self.url)
-
-    def _parse_budget(self, summary):
-        if "Hourly Range" in summary:
-            budget = re.search(
-                r'<b>Hourly Range</b>:([^\n]+)', summary).group(1)
-            budget = budget.strip()
-            budget_no_dollar = budget.replace('$', '')
-            return budget, float(budget_no_dollar.split("-")[0]), True
-        try:
-            budget = '$' + re.search(
-                r'<b>Budget</b>: \$(\d[0-9,.]+)',
-                summary
-            ).group(1)
-            budget = re.sub('<[^<]+?>', '', budget)
-        except AttributeError:
-            budget = 'N/A'
-        try:
-            return budget, int(budget[:-1]), False
-        except:
-            return budget, None, (budget == "N/A")
-
-    def _parse_country(self, summary):
-        try:
-            return re.search(
-                r'<b>Country</b>:([^\n]+)', summary).group(1)
-        except:
-            return 'N/A'
-
-    def _clean_summary(self, summary):
-        pattern = re.compile(r'<.*?>')
-        return pattern.sub('', summary)
-
-    def _parse_published(self, published_str):
-        # Format Example: Sat, 24 Oct 2020 03:06:03 +0000
-        user_timezone = self.user_settings.get("timezone", "UTC")
-        published = datetime.strptime(
-            published_str, '%a, %d %b %Y %H:%M:%S %z'
-        ).replace(tzinfo=pytz.utc).astimezone(pytz.timezone(user_timezone))
-        timenow = datetime.utcnow().replace(
-            tzinfo=pytz.utc).astimezone(pytz.timezone(user_timezone))
-        return timeago.format(published, timenow)
+        return feed_cache.get(self.url)
 
     def _filter_job(self, job: JobPost):
-        excluded_countries = self.user_filters.get("exclude_countries", None)
-
-        if excluded_countries is not None:
-            for country in excluded_countries:
-                if job.country.strip().lower() == country.lower():
-                    return False
-
-        return True
-
-    def parse_rss(self):
-        entries = self._load_rss().entries
+        return filter_index.get(self.user_id, self.user_filters)(job)
+
+    def new_posts(self, result: FeedResult = None) -> List[JobPost]:
+        if result is None:
+            result = self._load_rss()
+        entries = result.entries
+        feed = normalize_url(self.url)
+        # Feed didn't change since this user last parsed it, nothing to dedup
+        if not feed_cache.claim(self.url, result, self.user_id):
+            self._set_cursor(feed, result)
+            jobs_db.touch(self.user_id)
+            return []
+        with DEDUP_SECONDS.time(feed):
+            candidates = self._after_cursor(feed, result)
+            if candidates is None:
+                seen_ids = jobs_db.seen_job_ids(
+                    [entry['id'] for entry in entries], self.user_id)
+                candidates = [entry for entry in entries if entry['id'] not in seen_ids]
         job_posts = []
-        for entry in entries:
-            if jobs_db.job_exits(entry['id'], self.user_id):
+        new_ids = []
+        added = set()
+        for entry in candidates:
+            if entry['id'] in added:
                 continue
-            budget, budget_numeric, hourly = self._parse_budget(
-                entry['summary'])
-            country = self._parse_country(entry['summary'])
-            published = self._parse_published(entry['published'])
-            job_post = JobPost(
-                entry.get("id", "#"),
-                budget,
-                published,
-                entry.get("title"),
-                self._clean_summary(entry.get("summary")),
-                budget_numeric,
-                country,
-                hourly
-            )
-            if self._filter_job(job_post):
-                job_posts.append(job_post)
-            jobs_db.insert_job(entry["id"], self.user_id)
+            job_posts.append(parse_entry(entry))
+            added.add(entry["id"])
+            new_ids.append(entry["id"])
+        with DEDUP_SECONDS.time(feed):
+            # Still recorded, they're what the full check relies on
+            if new_ids:
+                jobs_db.insert_jobs(new_ids, self.user_id)
+            else:
+                jobs_db.touch(self.user_id)
+            self._set_cursor(feed, result)
         return job_posts
+
+    def _set_cursor(self, feed, result: FeedResult):
+        # Also when nothing changed, set_cursor keeps a quiet feed's cursor from expiring
+        if result.entries and result.ordered:
+            cursors_db.set_cursor(
+                feed, self.user_id, result.entries[0]['id'], entry_timestamp(result.entries[0]))
+
+    def _after_cursor(self, feed, result: FeedResult):
+        if not result.ordered:
+            CURSOR_FALLBACKS.inc("unordered")
+            return None
+        cursor = cursors_db.get_cursor(feed, self.user_id)
+        if cursor is None:
+            CURSOR_FALLBACKS.inc("no_cursor")
+            return None
+        candidates = _entries_after_cursor(result.entries, cursor)
+        if candidates is None:
+            CURSOR_FALLBACKS.inc("cursor_lost")
+        return candidates
+
+    def filter_posts(self, job_posts: List[JobPost], accepted: Optional[Set[str]] = None) -> List[JobPost]:
+        # accepted holds the urls FilterIndex already matched for this user
+        if accepted is not None:
+            return [job_post for job_post in job_posts if job_post.url in accepted]
+        return [job_post for job_post in job_posts if self._filter_job(job_post)]
+
+    def parse_rss(self, result: FeedResult = None) -> List[JobPost]:
+        return self.filter_posts(self.new_posts(result))
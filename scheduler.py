@@ -0,0 +1,271 @@
+import logging
+import random
+import threading
+import time
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from feed_fetcher import entry_timestamp, feed_cache, normalize_url
+from feed_health import FeedHealth, feed_health
+from helper import (
+    POLL_MAX_PERIOD,
+    POLL_MIN_PERIOD,
+    POLL_TARGET_POSTS,
+    PRIORITY_MAX_PERIOD,
+    REPEAT_PERIOD,
+    SCHEDULER_JITTER,
+    SCHEDULER_TICK,
+)
+from metrics import CYCLE_OVERRUNS, CYCLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Older observations count half as much every RATE_HALF_LIFE seconds
+RATE_HALF_LIFE = 3 * 60 * 60
+
+
+class PostRate:
+    # New posts per second of one feed, decayed so it follows the feed's busy and quiet hours
+    def __init__(self) -> None:
+        self.posts = 0.0
+        self.seconds = 0.0
+        self.newest = None
+        self.observed_at = None
+
+    def observe(self, entries, now):
+        timestamps = [ts for ts in map(entry_timestamp, entries) if ts is not None]
+        if not timestamps:
+            return
+        newest = max(timestamps)
+        if self.observed_at is None:
+            # First look, the feed's own history is the best guess
+            if len(timestamps) > 1 and newest > min(timestamps):
+                self.posts = len(timestamps) - 1
+                self.seconds = newest - min(timestamps)
+        else:
+            elapsed = now - self.observed_at
+            decay = 0.5 ** (elapsed / RATE_HALF_LIFE)
+            self.posts = self.posts * decay + sum(1 for ts in timestamps if ts > self.newest)
+            self.seconds = self.seconds * decay + elapsed
+        self.newest = max(newest, self.newest or newest)
+        self.observed_at = now
+
+    def per_second(self):
+        return self.posts / self.seconds if self.seconds else None
+
+
+class FeedScheduler:
+    def __init__(
+        self,
+        deliver: Callable[[List[Tuple[int, Dict[str, Any]]], Any], None],
+        health_changed: Optional[Callable[[List[Tuple[int, Dict[str, Any]]], FeedHealth], None]] = None,
+    ) -> None:
+        # deliver([(user_id, rss), ...], feed_result) sends every
+        # listed subscriber the new posts of one feed, health_changed tells
+        # them their feed got parked or works again
+        self.deliver = deliver
+        self.health_changed = health_changed
+        self.period = REPEAT_PERIOD * 60
+        self.min_period = POLL_MIN_PERIOD
+        self.max_period = POLL_MAX_PERIOD
+        self.priority_period = PRIORITY_MAX_PERIOD
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(dict)
+        self._user_feeds = defaultdict(set)
+        self._urls = {}
+        self._next_due = {}
+        self._rates = {}
+        self._feed_sizes = {}
+        self._checked = {}
+        self._paused = set()
+        self._priority = set()
+
+    def _interval(self, key):
+        rate = self._rates[key].per_second()
+        if rate is None:
+            interval = self.period
+        elif rate == 0:
+            interval = self.max_period
+        else:
+            interval = POLL_TARGET_POSTS / rate
+            size = self._feed_sizes.get(key)
+            if size:
+                # Posts pushed off the end of the feed before a poll would never be delivered
+                interval = min(interval, size / 2 / rate)
+        interval = min(max(interval, self.min_period), self.max_period)
+        if any(user_id in self._priority for user_id in self._subscribers[key]):
+            interval = min(interval, self.priority_period)
+        return interval
+
+    def _delay(self, key):
+        # Backed off while the feed keeps failing
+        return feed_health.delay(key, self._interval(key))
+
+    def _jitter(self, interval):
+        return random.uniform(-SCHEDULER_JITTER, SCHEDULER_JITTER) * interval
+
+    def set_user_feeds(self, user_id, rss_list: List[Dict[str, Any]]):
+        with self._lock:
+            for key in self._user_feeds.pop(user_id, set()):
+                self._subscribers[key].pop(user_id, None)
+                if not self._subscribers[key]:
+                    self._drop_feed(key)
+            for rss in rss_list:
+                key = normalize_url(rss["url"])
+                self._subscribers[key][user_id] = rss
+                self._user_feeds[user_id].add(key)
+                if key not in self._next_due:
+                    # Spread new feeds over the whole period instead of one burst
+                    self._urls[key] = rss["url"]
+                    self._rates[key] = PostRate()
+                    self._next_due[key] = time.monotonic() + random.uniform(0, self._delay(key))
+            if user_id in self._priority:
+                self._hurry(user_id)
+
+    def _drop_feed(self, key):
+        del self._subscribers[key]
+        self._urls.pop(key, None)
+        self._next_due.pop(key, None)
+        self._rates.pop(key, None)
+        self._feed_sizes.pop(key, None)
+        self._checked.pop(key, None)
+
+    def _hurry(self, user_id):
+        # Brings a priority user's feeds forward instead of waiting out their current period
+        latest = time.monotonic() + self.priority_period
+        for key in self._user_feeds.get(user_id, set()):
+            if self._next_due[key] > latest:
+                self._next_due[key] = latest - random.uniform(0, self.priority_period)
+
+    def set_priority(self, user_id, high: bool):
+        with self._lock:
+            if not high:
+                self._priority.discard(user_id)
+            elif user_id not in self._priority:
+                self._priority.add(user_id)
+                self._hurry(user_id)
+
+    def retry_feed(self, url):
+        # Someone added a failing feed again, give it another go right away
+        key = normalize_url(url)
+        if not feed_health.get(key).failures:
+            return
+        feed_health.reset(key)
+        with self._lock:
+            if key in self._next_due:
+                self._next_due[key] = time.monotonic()
+
+    def pause(self, user_id):
+        with self._lock:
+            self._paused.add(user_id)
+
+    def resume(self, user_id):
+        with self._lock:
+            self._paused.discard(user_id)
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._user_feeds)
+
+    def is_paused(self, user_id):
+        return user_id in self._paused
+
+    def _take_due(self, now):
+        with self._lock:
+            due = [key for key, next_due in self._next_due.items() if next_due <= now]
+            for key in due:
+                self._schedule(key, now)
+            return [(key, self._urls[key]) for key in due]
+
+    def _schedule(self, key, now):
+        if key in self._next_due:
+            delay = self._delay(key)
+            self._next_due[key] = now + delay + self._jitter(delay)
+
+    def _observe(self, key, result):
+        with self._lock:
+            rate = self._rates.get(key)
+            if rate is not None:
+                rate.observe(result.entries, time.time())
+                self._feed_sizes[key] = len(result.entries)
+
+    def _active_subscribers(self, key):
+        with self._lock:
+            return [(user_id, rss) for user_id, rss in self._subscribers.get(key, {}).items()
+                    if user_id not in self._paused]
+
+    def _check_health(self, key, result, started):
+        if isinstance(result, Exception):
+            changed = feed_health.record_failure(key, result)
+        elif self._checked.get(key) is not result:
+            # A body served from the cache says nothing new about the feed
+            self._checked[key] = result
+            changed = feed_health.record_success(key, result)
+        else:
+            return
+        with self._lock:
+            self._schedule(key, started)
+        if changed and self.health_changed is not None:
+            subscribers = self._active_subscribers(key)
+            if subscribers:
+                self.health_changed(subscribers, feed_health.get(key))
+
+    def _fan_out(self, key, result):
+        self._observe(key, result)
+        subscribers = self._active_subscribers(key)
+        if not subscribers:
+            return
+        try:
+            self.deliver(subscribers, result)
+        except Exception:
+            logger.exception(f"Delivering {self._urls.get(key, key)} failed")
+
+    def _run_feeds(self, feeds, started):
+        keys = {url: key for key, url in feeds}
+        for url, result in feed_cache.iter_many(keys):
+            key = keys[url]
+            try:
+                self._check_health(key, result, started)
+            except Exception:
+                logger.exception(f"Recording the health of {url} failed")
+            if isinstance(result, Exception):
+                logger.warning(f"Skipping feed {url}: {result}")
+                continue
+            self._fan_out(key, result)
+
+    def tick(self, context):
+        start = time.monotonic()
+        feeds = self._take_due(start)
+        if feeds:
+            self._run_feeds(feeds, start)
+            duration = time.monotonic() - start
+            CYCLE_SECONDS.observe(duration)
+            if duration > SCHEDULER_TICK:
+                # The next tick already started late
+                CYCLE_OVERRUNS.inc()
+
+    def run_user(self, user_id):
+        if self.is_paused(user_id):
+            return False
+        with self._lock:
+            feeds = [(key, self._urls[key]) for key in self._user_feeds.get(user_id, set())]
+            subscriptions = {key: self._subscribers[key][user_id] for key, _ in feeds}
+        keys = {url: key for key, url in feeds}
+        for url, result in feed_cache.iter_many(keys):
+            if isinstance(result, Exception):
+                logger.warning(f"Skipping feed {url}: {result}")
+                continue
+            try:
+                self.deliver([(user_id, subscriptions[keys[url]])], result)
+            except Exception:
+                logger.exception(f"Delivering {url} to {user_id} failed")
+        return True
+
+    def summary(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (self._urls[key], len(self._subscribers[key]), int(next_due - now), int(self._interval(key)))
+                for key, next_due in sorted(self._next_due.items(), key=lambda item: item[1])
+            ]
@@ -0,0 +1,125 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Set
+
+from helper import SHARD_COUNT, SHARD_LEASE_TTL
+from storage import ShardLeasesDB, WorkersDB
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(user_id: int, shard_count: int = SHARD_COUNT) -> int:
+    return abs(user_id) % shard_count
+
+
+class ShardCoordinator:
+    # Keeps this worker's fair share of shard leases: renews what it holds, takes free or
+    # expired shards up to ceil(shards / live workers) and gives back anything above that
+    def __init__(
+        self,
+        worker_id: str,
+        on_acquire: Callable[[Set[int]], None],
+        on_release: Callable[[Set[int]], None],
+        shard_count: int = SHARD_COUNT,
+        lease_ttl: float = SHARD_LEASE_TTL,
+    ) -> None:
+        self.worker_id = worker_id
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.live_workers = 1
+        self.workers_db = WorkersDB()
+        self.leases_db = ShardLeasesDB(shard_count)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._owned = set()
+        # Deliveries running per shard, a shard is only released once it has none
+        self._busy = Counter()
+        # Leases are wall clock in Mongo, stop delivering a while before they can expire
+        self._valid_until = 0
+
+    def owns(self, user_id) -> bool:
+        return (shard_of(user_id, self.shard_count) in self._owned
+                and time.monotonic() < self._valid_until)
+
+    def owned_shards(self) -> Set[int]:
+        with self._lock:
+            return set(self._owned)
+
+    @contextmanager
+    def delivering(self, user_ids):
+        # Yields the given users this worker owns. Their shards stay leased until the block
+        # exits, a delivery still recording cursors can't race the next owner's reload
+        with self._lock:
+            owned = [user_id for user_id in user_ids if self.owns(user_id)]
+            shards = {shard_of(user_id, self.shard_count) for user_id in owned}
+            self._busy.update(shards)
+        try:
+            yield owned
+        finally:
+            with self._lock:
+                self._busy.subtract(shards)
+                self._idle.notify_all()
+
+    def _drop(self, shards):
+        with self._lock:
+            self._owned -= shards
+            # New deliveries skip these users now, the running ones get to finish
+            if not self._idle.wait_for(lambda: not any(self._busy[shard] > 0 for shard in shards),
+                                       timeout=self.lease_ttl):
+                logger.warning(f"Releasing shards {sorted(shards)} with deliveries still running")
+        self.on_release(shards)
+
+    def heartbeat(self, context=None):
+        started = time.monotonic()
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.lease_ttl)
+        self.workers_db.heartbeat(self.worker_id, now)
+        self.live_workers = max(1, len(self.workers_db.live_workers(now - timedelta(seconds=self.lease_ttl))))
+
+        held = self.leases_db.renew(self.worker_id, expires_at)
+        self._valid_until = started + self.lease_ttl * 0.75
+        lost = self._owned - held
+        if lost:
+            logger.warning(f"Lost shards {sorted(lost)}")
+            self._drop(lost)
+
+        target = math.ceil(self.shard_count / self.live_workers)
+        extra = sorted(held, reverse=True)[:max(0, len(held) - target)]
+        if extra:
+            # Stop delivering first, only then let someone else take them
+            self._drop(set(extra))
+            for shard in extra:
+                self.leases_db.release(shard, self.worker_id)
+            held -= set(extra)
+
+        gained = set()
+        if len(held) < target:
+            free = self.leases_db.free_shards(now)
+            random.shuffle(free)
+            for shard in free:
+                if len(held) + len(gained) >= target:
+                    break
+                if self.leases_db.acquire(shard, self.worker_id, now, expires_at):
+                    gained.add(shard)
+        gained |= held - self._owned
+        if gained:
+            logger.info(f"Took shards {sorted(gained)}")
+            self.on_acquire(gained)
+            with self._lock:
+                self._owned |= gained
+
+    def stop(self):
+        shards = self.owned_shards()
+        self._drop(shards)
+        for shard in shards:
+            self.leases_db.release(shard, self.worker_id)
+        self.workers_db.remove(self.worker_id)
@@ -1,6 +1,19 @@
+import hashlib
+import threading
 import pymongo
+import pymongo.errors
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from decouple import config
-from helper import ITERABLE_FILTERS
+from helper import (
+    ITERABLE_FILTERS,
+    JOB_POSTS_RETENTION_DAYS,
+    SEEN_CACHE_SIZE,
+    SEEN_JOBS_PER_USER,
+    SHARD_COUNT,
+    USER_CACHE_SIZE,
+)
+from metrics import MongoCommandListener, watch_cache
 
 
 class RSSFeed:
@@ -18,133 +31,825 @@ class RSSFeed:
         }
 
 
-print(config("DB_CONNECTION"))
+_client = None
+_database = None
+_database_lock = threading.Lock()
 
 
-class UsersDB:
+def get_database():
+    # One client and connection pool for the whole process, created on first use
+    global _client, _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _client = pymongo.MongoClient(
+                    config("DB_CONNECTION"),
+                    maxPoolSize=config("DB_POOL_SIZE", cast=int, default=50),
+                    connect=False,
+                    event_listeners=[MongoCommandListener()]
+                )
+                _database = _client[config("DB_NAME")]
+    return _database
+
+
+def use_database(database):
+    # Lets tools run against another database object, ex: an in-memory one
+    global _database
+    with _database_lock:
+        _database = database
+
+
+class LazyCollection:
+    collection_name = None
+
     def __init__(self) -> None:
-        self.db_client = pymongo.MongoClient(config("DB_CONNECTION"))
-        self.db = self.db_client[config("DB_NAME")]
-        self.users = self.db["users"]
-        if "users" not in self.db.list_collection_names():
-            self._init_db()
-            print("created collection")
-
-    def _init_db(self):
-        dummy = {
-            "rss": [],
-            "settings": {},
-            "filters": {},
-            "id": 1
-        }
-        self.users.insert_one(dummy)
+        self._collection = None
+        self._init_lock = threading.Lock()
+
+    def _init_collection(self, collection):
+        pass
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            with self._init_lock:
+                if self._collection is None:
+                    collection = get_database()[self.collection_name]
+                    self._init_collection(collection)
+                    self._collection = collection
+        return self._collection
+
+
+class LRUCache:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return self.hits, self.misses, len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+DEFAULT_USER = {
+    "rss": [],
+    "settings.timezone": "UTC",
+    "settings.show_summary": "no",
+    "filters.exclude_countries": [],
+}
+
+
+def _defaults_except(*paths):
+    # $setOnInsert can't touch a path the same update already writes
+    def conflicts(default_path):
+        return any(
+            default_path == path
+            or default_path.startswith(path + ".")
+            or path.startswith(default_path + ".")
+            for path in paths
+        )
+    return {path: value for path, value in DEFAULT_USER.items() if not conflicts(path)}
+
+
+class UsersDB(LazyCollection):
+    collection_name = "users"
+
+    def __init__(self) -> None:
+        super().__init__()
+        # Users only change through this process, or a worker's sync refreshes them
+        self.cache = LRUCache(USER_CACHE_SIZE)
+        watch_cache("users", lambda: self.cache.stats())
+
+    def _init_collection(self, users):
+        try:
+            users.create_index("id", unique=True)
+        except pymongo.errors.DuplicateKeyError:
+            print("users has duplicate ids, unique index on id not created")
+        users.create_index("updated_at")
+
+    @property
+    def users(self):
+        return self.collection
 
     def get_all_users(self):
         for document in self.users.find():
             yield document
 
-    def get_user(self, user_id):
-        user = self.users.find_one({
-            "id": user_id
-        })
-        if user is not None:
-            return user
-        self.users.insert_one(
+    def get_subscribed_users(self, shards=None, shard_count=SHARD_COUNT, batch_size=1000):
+        # Users with at least one feed, only those in the given shards when set
+        query = {"rss.0": {"$exists": True}}
+        if shards is not None:
+            if not shards:
+                return
+            # $mod keeps the sign of negative (group chat) ids
+            query["$or"] = [
+                {"id": {"$mod": [shard_count, remainder]}}
+                for shard in shards for remainder in {shard, -shard}
+            ]
+        # Just what scheduling a user needs
+        projection = {
+            "_id": 0,
+            "id": 1,
+            "rss": 1,
+            "filters": 1,
+            "settings.priority": 1,
+            "paused": 1
+        }
+        yield from self.users.find(query, projection, batch_size=batch_size)
+
+    def last_updated_at(self):
+        # Newest updated_at, by the clocks of the processes that wrote it
+        for user in self.users.find(
             {
-                "id": user_id,
-                "rss": [],
-                "settings": {
-                    "timezone": "UTC",
-                    "show_summary": "no",
-                },
-                "filters": {
-                    "exclude_countries": [],
-                }
+                "updated_at": {"$exists": True}
+            },
+            {
+                "_id": 0,
+                "updated_at": 1
             }
-        )
-        return self.users.find_one({
-            "id": user_id
-        })
+        ).sort("updated_at", pymongo.DESCENDING).limit(1):
+            return user["updated_at"]
+        return None
+
+    def get_users_changed_since(self, since):
+        users = list(self.users.find({"updated_at": {"$gte": since}}))
+        for user in users:
+            self.cache.put(user["id"], user)
+        return users
 
-    def _update_user(self, user_id, updated_user):
-        self.users.find_one_and_replace(
+    def _upsert_user(self, user_id, update, *paths):
+        update = dict(update)
+        if update:
+            # Workers pick up changed users by this
+            update["$set"] = dict(update.get("$set", {}), updated_at=datetime.utcnow())
+        defaults = _defaults_except(*paths)
+        if defaults:
+            update["$setOnInsert"] = defaults
+        user = self.users.find_one_and_update(
             {
                 "id": user_id
             },
-            updated_user
+            update,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
         )
+        self.cache.put(user_id, user)
+        return user
+
+    def get_user(self, user_id):
+        # Returned documents are shared with the cache, don't modify them
+        user = self.cache.get(user_id)
+        if user is not None:
+            return user
+        return self._upsert_user(user_id, {})
 
     def get_user_rss(self, user_id):
         user = self.get_user(user_id)
         return user["rss"]
 
     def add_user_rss(self, user_id, rss: RSSFeed):
-        user = self.get_user(user_id)
-        user["rss"].append(rss.to_dict())
-        self._update_user(user_id, user)
+        return self._upsert_user(
+            user_id, {"$push": {"rss": rss.to_dict()}}, "rss")
 
     def delete_user_rss(self, user_id, rss_name):
-        user = self.get_user(user_id)
-        user["rss"] = [rss for rss in user["rss"]
-                       if rss.get("name") != rss_name]
-        self._update_user(user_id, user)
+        return self._upsert_user(
+            user_id, {"$pull": {"rss": {"name": rss_name}}}, "rss")
 
     def get_user_settings(self, user_id):
         user = self.get_user(user_id)
         return user["settings"]
 
     def set_user_settings(self, user_id, key, value):
-        user = self.get_user(user_id)
-        user["settings"][key] = value
-        self._update_user(user_id, user)
+        path = f"settings.{key}"
+        return self._upsert_user(user_id, {"$set": {path: value}}, path)
 
     def get_user_filters(self, user_id):
         user = self.get_user(user_id)
         return user["filters"]
 
     def set_user_filter(self, user_id, key, value):
-        user = self.get_user(user_id)
-        if key in ITERABLE_FILTERS and key in user["filters"]:
-            user["filters"][key].extend(value)
-            user["filters"][key] = list(set(user["filters"][key]))
+        path = f"filters.{key}"
+        if key in ITERABLE_FILTERS:
+            update = {"$addToSet": {path: {"$each": list(value)}}}
         else:
-            user["filters"][key] = list(set(value))
-        self._update_user(user_id, user)
+            update = {"$set": {path: value}}
+        user = self._upsert_user(user_id, update, path)
         return user["filters"][key]
 
     def clear_user_filter(self, user_id, key):
-        user = self.get_user(user_id)
-        if key in user["filters"]:
-            user["filters"].pop(key)
-        self._update_user(user_id, user)
+        path = f"filters.{key}"
+        user = self.users.find_one_and_update(
+            {
+                "id": user_id
+            },
+            {
+                "$unset": {path: ""},
+                "$set": {"updated_at": datetime.utcnow()}
+            },
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if user is None:
+            # Nothing to clear for a new user, upserting here would leave no filters at all
+            return self.get_user(user_id)
+        self.cache.put(user_id, user)
+        return user
+
+    def set_paused(self, user_id, paused: bool):
+        return self._upsert_user(user_id, {"$set": {"paused": paused}}, "paused")
 
+    def request_run(self, user_id):
+        # Asks the worker owning this user for an immediate /get_jobs
+        return self._upsert_user(user_id, {"$set": {"run_requested": True}}, "run_requested")
+
+    def request_feed_retry(self, user_id, url):
+        # Asks the worker owning this user to poll a failing feed again right away
+        return self._upsert_user(user_id, {"$addToSet": {"retry_feeds": url}}, "retry_feeds")
+
+    def take_feed_retries(self, user_id):
+        # Each requested url goes to exactly one caller
+        user = self.users.find_one_and_update(
+            {
+                "id": user_id,
+                "retry_feeds": {"$exists": True}
+            },
+            {
+                "$unset": {"retry_feeds": ""}
+            },
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if user is None:
+            return []
+        retry_feeds = user.pop("retry_feeds")
+        self.cache.put(user_id, user)
+        return retry_feeds
+
+    def take_run_request(self, user_id):
+        # True for exactly one caller per request
+        user = self.users.find_one_and_update(
+            {
+                "id": user_id,
+                "run_requested": True
+            },
+            {
+                "$set": {"run_requested": False}
+            },
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if user is None:
+            return False
+        self.cache.put(user_id, user)
+        return True
+
+
+# Documents under a TTL index that are still in use get their updated_at
+# written again this often, even when nothing else changed
+TTL_REFRESH_INTERVAL = timedelta(days=JOB_POSTS_RETENTION_DAYS) / 4
+
+
+def _ttl_index(collection, field, seconds):
+    try:
+        collection.create_index(field, expireAfterSeconds=seconds)
+    except pymongo.errors.OperationFailure:
+        # TTL index already exists with a different retention
+        collection.database.command(
+            "collMod",
+            collection.name,
+            index={
+                "keyPattern": {field: 1},
+                "expireAfterSeconds": seconds
+            }
+        )
+
+
+def job_hash(job_id: str) -> int:
+    # Fits a BSON long, a collision inside one user's window is practically impossible
+    return int.from_bytes(
+        hashlib.blake2b(job_id.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+class SeenCache(LRUCache):
+    # Bounded LRU of (user_id, job hash) pairs known to be delivered already
+    def __init__(self, max_size: int = SEEN_CACHE_SIZE) -> None:
+        super().__init__(max_size)
+
+    def contains(self, user_id, job_hash):
+        return self.get((user_id, job_hash)) is not None
+
+    def add(self, user_id, job_hash):
+        self.put((user_id, job_hash), True)
+
+
+class JobPostDB(LazyCollection):
+    # Delivered jobs as one document per user: {user_id, hashes, updated_at},
+    # hashes holds the job_hash of the last SEEN_JOBS_PER_USER jobs
+    collection_name = "seen_jobs"
+    # One {job_id, user_id, created_at} document per delivered job, read until migrated
+    legacy_collection_name = "job_posts"
 
-class JobPostDB:
     def __init__(self) -> None:
-        self.db_client = pymongo.MongoClient(config("DB_CONNECTION"))
-        self.db = self.db_client[config("DB_NAME")]
-        self.jobs = self.db["job_posts"]
-        if "job_posts" not in self.db.list_collection_names():
-            self._init_db()
-            print("created collection")
-
-    def _init_db(self):
-        dummy = {
-            "job_id": "1",
-            "user_id": 1
-        }
-        self.jobs.insert_one(dummy)
+        super().__init__()
+        self.seen_cache = SeenCache()
+        self._legacy = None
+        # When each user's window was last written by this process
+        self._written = {}
+        watch_cache("seen_jobs", lambda: self.seen_cache.stats())
 
-    def job_exits(self, job_id, user_id):
-        job = self.jobs.find_one({
-            "job_id": job_id,
-            "user_id": user_id
-        })
+    def _init_collection(self, seen):
+        seen.create_index("user_id", unique=True)
+        # Users that got nothing for a while don't need their history
+        _ttl_index(seen, "updated_at", JOB_POSTS_RETENTION_DAYS * 24 * 60 * 60)
+        legacy = seen.database[self.legacy_collection_name]
+        if legacy.find_one({}, {"_id": 1}) is not None:
+            self._init_legacy(legacy)
+            self._legacy = legacy
+        self._warm_seen_cache(seen)
 
-        return job is not None
+    def _init_legacy(self, legacy):
+        # Read on every cursor fallback until it's empty, it needs its lookup index and
+        # its TTL even when upgrading from a version that had neither
+        legacy.update_many(
+            {
+                "created_at": {"$exists": False}
+            },
+            {
+                "$set": {"created_at": datetime.utcnow()}
+            }
+        )
+        try:
+            legacy.create_index(
+                [("user_id", pymongo.ASCENDING), ("job_id", pymongo.ASCENDING)],
+                unique=True
+            )
+        except pymongo.errors.DuplicateKeyError:
+            self._drop_duplicate_legacy_jobs(legacy)
+            legacy.create_index(
+                [("user_id", pymongo.ASCENDING), ("job_id", pymongo.ASCENDING)],
+                unique=True
+            )
+        _ttl_index(legacy, "created_at", JOB_POSTS_RETENTION_DAYS * 24 * 60 * 60)
+
+    def _drop_duplicate_legacy_jobs(self, legacy):
+        duplicates = legacy.aggregate([
+            {
+                "$group": {
+                    "_id": {"user_id": "$user_id", "job_id": "$job_id"},
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}
+                }
+            },
+            {
+                "$match": {"count": {"$gt": 1}}
+            }
+        ], allowDiskUse=True)
+        for duplicate in duplicates:
+            legacy.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+    @property
+    def seen(self):
+        return self.collection
+
+    def _warm_seen_cache(self, seen):
+        if self.seen_cache.max_size <= 0:
+            return
+        recent = []
+        count = 0
+        users = seen.find(
+            {},
+            {
+                "_id": 0,
+                "user_id": 1,
+                "hashes": 1
+            }
+        ).sort("updated_at", pymongo.DESCENDING)
+        for user in users:
+            recent.append(user)
+            count += len(user["hashes"])
+            if count >= self.seen_cache.max_size:
+                break
+        # Oldest first so the most recent posts end up least likely to be evicted
+        for user in reversed(recent):
+            for hashed in user["hashes"]:
+                self.seen_cache.add(user["user_id"], hashed)
+
+    def job_exits(self, job_id, user_id):
+        return job_id in self.seen_job_ids([job_id], user_id)
 
     def insert_job(self, job_id, user_id):
-        self.jobs.insert_one({
-            "job_id": job_id,
-            "user_id": user_id
-        })
+        self.insert_jobs([job_id], user_id)
+
+    def seen_job_ids(self, job_ids, user_id):
+        hashes = {job_hash(job_id): job_id for job_id in job_ids}
+        seen = {job_id for hashed, job_id in hashes.items()
+                if self.seen_cache.contains(user_id, hashed)}
+        unknown = [hashed for hashed, job_id in hashes.items() if job_id not in seen]
+        if not unknown:
+            return seen
+        # Only the matching hashes come back, not the user's whole window
+        users = self.seen.aggregate([
+            {
+                "$match": {"user_id": user_id}
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "hashes": {"$setIntersection": ["$hashes", unknown]}
+                }
+            }
+        ])
+        for user in users:
+            for hashed in user["hashes"]:
+                seen.add(hashes[hashed])
+                self.seen_cache.add(user_id, hashed)
+        if self._legacy is not None:
+            seen |= self._legacy_seen_job_ids(
+                [job_id for job_id in hashes.values() if job_id not in seen], user_id)
+        return seen
+
+    def _legacy_seen_job_ids(self, job_ids, user_id):
+        if not job_ids:
+            return set()
+        jobs = self._legacy.find(
+            {
+                "user_id": user_id,
+                "job_id": {"$in": job_ids}
+            },
+            {
+                "_id": 0,
+                "job_id": 1
+            }
+        )
+        seen = {job["job_id"] for job in jobs}
+        # Moved over as they're found, the legacy documents expire on their own
+        self.insert_jobs(list(seen), user_id)
+        return seen
+
+    def touch(self, user_id):
+        # Quiet feeds write no new jobs, the window of a user still polling them is kept anyway
+        now = datetime.utcnow()
+        if now - self._written.get(user_id, datetime.min) < TTL_REFRESH_INTERVAL:
+            return
+        self._written[user_id] = now
+        self.seen.update_one(
+            {
+                "user_id": user_id
+            },
+            {
+                "$set": {"updated_at": now}
+            }
+        )
+
+    def insert_jobs(self, job_ids, user_id):
+        if not job_ids:
+            return
+        hashes = list(dict.fromkeys(job_hash(job_id) for job_id in job_ids))
+        for hashed in hashes:
+            self.seen_cache.add(user_id, hashed)
+        self._written[user_id] = datetime.utcnow()
+        self.seen.update_one(
+            {
+                "user_id": user_id
+            },
+            {
+                "$push": {
+                    "hashes": {"$each": hashes, "$slice": -SEEN_JOBS_PER_USER}
+                },
+                "$set": {"updated_at": datetime.utcnow()}
+            },
+            upsert=True
+        )
+
+    def migrate_legacy_jobs(self, batch_size=1000):
+        # Copies every job_posts document into seen_jobs then drops job_posts,
+        # returns how many documents were copied
+        self.seen  # finds out whether job_posts is still there
+        if self._legacy is None:
+            return 0
+        jobs = self._legacy.find(
+            {},
+            {
+                "_id": 0,
+                "user_id": 1,
+                "job_id": 1
+            },
+            batch_size=batch_size
+        ).sort([("user_id", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+        migrated = 0
+        user_id, job_ids = None, []
+        for job in jobs:
+            if job["user_id"] != user_id or len(job_ids) >= batch_size:
+                self.insert_jobs(job_ids, user_id)
+                user_id, job_ids = job["user_id"], []
+            job_ids.append(job["job_id"])
+            migrated += 1
+        self.insert_jobs(job_ids, user_id)
+        self._legacy.drop()
+        self._legacy = None
+        return migrated
+
+
+class FeedsDB(LazyCollection):
+    collection_name = "feeds"
+
+    def _init_collection(self, feeds):
+        feeds.create_index("url", unique=True)
+
+    @property
+    def feeds(self):
+        return self.collection
+
+    def get_validators(self, url):
+        feed = self.feeds.find_one(
+            {
+                "url": url
+            },
+            {
+                "_id": 0,
+                "etag": 1,
+                "modified": 1
+            }
+        )
+        return feed or {}
+
+    def set_validators(self, url, etag, modified):
+        self.feeds.update_one(
+            {
+                "url": url
+            },
+            {
+                "$set": {
+                    "etag": etag,
+                    "modified": modified
+                }
+            },
+            upsert=True
+        )
+
+    def get_health(self):
+        feeds = self.feeds.find(
+            {
+                "health": {"$exists": True}
+            },
+            {
+                "_id": 0,
+                "url": 1,
+                "health": 1
+            }
+        )
+        for feed in feeds:
+            yield feed["url"], feed["health"]
+
+    def get_feed_health(self, url):
+        feed = self.feeds.find_one(
+            {
+                "url": url
+            },
+            {
+                "_id": 0,
+                "health": 1
+            }
+        )
+        return (feed or {}).get("health")
+
+    def set_health(self, url, health):
+        self.feeds.update_one(
+            {
+                "url": url
+            },
+            {
+                "$set": {"health": health}
+            },
+            upsert=True
+        )
+
+
+class CursorsDB(LazyCollection):
+    # Newest entry each subscriber got from each feed, kept in memory like the users
+    collection_name = "feed_cursors"
+    cursor_fields = {
+        "_id": 0,
+        "url": 1,
+        "user_id": 1,
+        "entry_id": 1,
+        "published": 1,
+        "updated_at": 1
+    }
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._cursors = {}
+        # Off outside BOT_ROLE=all, workers load the users of the shards they get with reload_users
+        self.preload = True
+
+    def _init_collection(self, cursors):
+        cursors.create_index(
+            [("url", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)],
+            unique=True
+        )
+        cursors.create_index("user_id")
+        # A missing cursor only means a full dedup check, set_cursor keeps the
+        # cursors of quiet feeds from expiring along with the seen jobs
+        _ttl_index(cursors, "updated_at", JOB_POSTS_RETENTION_DAYS * 24 * 60 * 60)
+        if self.preload:
+            self._load(cursors.find({}, self.cursor_fields))
+
+    def _load(self, loaded):
+        for cursor in loaded:
+            self._cursors[(cursor["url"], cursor["user_id"])] = cursor
+
+    @property
+    def cursors(self):
+        return self.collection
+
+    def get_cursor(self, url, user_id):
+        self.cursors  # preloads cursors on first use
+        return self._cursors.get((url, user_id))
+
+    def reload_users(self, user_ids):
+        # Another worker may have moved these users' cursors
+        self._load(self.cursors.find({"user_id": {"$in": list(user_ids)}}, self.cursor_fields))
+
+    def forget_users(self, user_ids):
+        user_ids = set(user_ids)
+        for key in [key for key in list(self._cursors) if key[1] in user_ids]:
+            self._cursors.pop(key, None)
+
+    def forget_feeds(self, user_id, urls):
+        # Drops a user's cursors of feeds other than urls from memory
+        for key in [key for key in list(self._cursors) if key[1] == user_id and key[0] not in urls]:
+            self._cursors.pop(key, None)
+
+    def delete_feeds(self, user_id, urls):
+        # Same, and from the database
+        self.cursors.delete_many(
+            {
+                "user_id": user_id,
+                "url": {"$nin": list(urls)}
+            }
+        )
+        self.forget_feeds(user_id, urls)
+
+    def set_cursor(self, url, user_id, entry_id, published):
+        now = datetime.utcnow()
+        cursor = {
+            "url": url,
+            "user_id": user_id,
+            "entry_id": entry_id,
+            "published": published,
+            "updated_at": now
+        }
+        current = self.get_cursor(url, user_id)
+        if (current is not None and (current["entry_id"], current["published"]) == (entry_id, published)
+                and now - current.get("updated_at", datetime.min) < TTL_REFRESH_INTERVAL):
+            return
+        self.cursors.update_one(
+            {
+                "url": url,
+                "user_id": user_id
+            },
+            {
+                "$set": {
+                    "entry_id": entry_id,
+                    "published": published,
+                    "updated_at": now
+                }
+            },
+            upsert=True
+        )
+        self._cursors[(url, user_id)] = cursor
+
+
+class WorkersDB(LazyCollection):
+    collection_name = "workers"
+
+    def _init_collection(self, workers):
+        workers.create_index("worker_id", unique=True)
+
+    @property
+    def workers(self):
+        return self.collection
+
+    def heartbeat(self, worker_id, now: datetime):
+        self.workers.update_one(
+            {
+                "worker_id": worker_id
+            },
+            {
+                "$set": {"heartbeat_at": now}
+            },
+            upsert=True
+        )
+
+    def live_workers(self, since: datetime):
+        workers = self.workers.find(
+            {
+                "heartbeat_at": {"$gt": since}
+            },
+            {
+                "_id": 0,
+                "worker_id": 1
+            }
+        )
+        return [worker["worker_id"] for worker in workers]
+
+    def remove(self, worker_id):
+        self.workers.delete_many({"worker_id": worker_id})
+
+
+class ShardLeasesDB(LazyCollection):
+    # One {shard, owner, expires_at} document per shard, created up front so
+    # taking a lease is a single conditional update
+    collection_name = "shard_leases"
+
+    def __init__(self, shard_count: int = SHARD_COUNT) -> None:
+        super().__init__()
+        self.shard_count = shard_count
+
+    def _init_collection(self, leases):
+        leases.create_index("shard", unique=True)
+        try:
+            leases.insert_many(
+                [
+                    {"shard": shard, "owner": None, "expires_at": datetime(1970, 1, 1)}
+                    for shard in range(self.shard_count)
+                ],
+                ordered=False
+            )
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+
+    @property
+    def leases(self):
+        return self.collection
+
+    def _free(self, now):
+        return {"$or": [{"owner": None}, {"expires_at": {"$lt": now}}]}
+
+    def renew(self, owner, expires_at: datetime):
+        # Returns the shards still held, a lease that expired and got taken is gone
+        self.leases.update_many(
+            {
+                "owner": owner
+            },
+            {
+                "$set": {"expires_at": expires_at}
+            }
+        )
+        return {lease["shard"] for lease in self.leases.find({"owner": owner}, {"_id": 0, "shard": 1})}
+
+    def free_shards(self, now: datetime):
+        leases = self.leases.find(
+            dict(self._free(now), shard={"$lt": self.shard_count}),
+            {"_id": 0, "shard": 1}
+        )
+        return [lease["shard"] for lease in leases]
+
+    def acquire(self, shard, owner, now: datetime, expires_at: datetime):
+        lease = self.leases.find_one_and_update(
+            dict(self._free(now), shard=shard),
+            {
+                "$set": {"owner": owner, "expires_at": expires_at}
+            }
+        )
+        return lease is not None
+
+    def release(self, shard, owner):
+        self.leases.update_one(
+            {
+                "shard": shard,
+                "owner": owner
+            },
+            {
+                "$set": {"owner": None}
+            }
+        )
+
+    def owners(self, now: datetime):
+        # {owner: shard count} of the leases still valid
+        owners = {}
+        for lease in self.leases.find({"expires_at": {"$gte": now}}, {"_id": 0, "owner": 1}):
+            if lease["owner"] is not None:
+                owners[lease["owner"]] = owners.get(lease["owner"], 0) + 1
+        return owners
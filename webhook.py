@@ -0,0 +1,70 @@
+import hmac
+import json
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Telegram never sends anything close to this
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    # Accepts the updates Telegram POSTs to the webhook and queues them for the dispatcher,
+    # every request is handled on its own thread and answered as soon as it's queued
+    def __init__(self, bot: telegram.Bot, update_queue: Queue, path: str, secret: str) -> None:
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path or "/"
+        self.secret = secret
+        self._httpd = None
+
+    def _handle(self, request: BaseHTTPRequestHandler):
+        if request.path.split("?")[0] != self.path:
+            request.send_error(404)
+            return
+        secret = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(secret.encode("utf-8"), self.secret.encode("utf-8")):
+            logger.warning(f"Rejected webhook request from {request.client_address[0]}: bad secret token")
+            request.send_error(403)
+            return
+        length = int(request.headers.get("Content-Length") or 0)
+        if not 0 < length <= MAX_BODY_SIZE:
+            request.send_error(400)
+            return
+        try:
+            update = telegram.Update.de_json(json.loads(request.rfile.read(length)), self.bot)
+        except (ValueError, TypeError, KeyError):
+            request.send_error(400)
+            return
+        self.update_queue.put(update)
+        request.send_response(200)
+        request.send_header("Content-Length", "0")
+        request.end_headers()
+
+    def start(self, listen: str, port: int):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                server._handle(self)
+
+        self._httpd = ThreadingHTTPServer((listen, port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="webhook", daemon=True).start()
+        logger.info(f"Listening for webhook updates on {listen}:{port}{self.path}")
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None